@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from util.consts import DATA_DIR, MAX_CACHE_SIZE
+from util.profiles import get_profile, model_versions
+
+
+def result_key(content: str, params: dict) -> str:
+    # content is the video hash, or the video id for videos uploaded before they were hashed. The results of
+    # another profile are not reused.
+    key = json.dumps({"content": content, "models": model_versions(), "profile": get_profile(), "params": params},
+        sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def dir_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class ResultCache:
+    # Content hash of each uploaded video, stored as `cache.json` in the data directory, with the last
+    # access time of each video directory. When the directories grow over `max_size`, the least recently used
+    # ones are removed.
+
+    def __init__(self, max_size: int = MAX_CACHE_SIZE):
+        self.max_size = max_size
+        self.videos: Dict[str, str] = {}
+        self.hashes: Dict[str, str] = {}
+        self.access: Dict[str, float] = {}
+
+    @property
+    def path(self) -> Path:
+        return Path(DATA_DIR) / "cache.json"
+
+    def load(self):
+        if self.path.exists():
+            with open(self.path, "r", encoding="UTF-8") as f:
+                info = json.load(f)
+            self.hashes = info["hashes"]
+            self.access = info["access"]
+        # drop the entries of directories removed by hand
+        self.hashes = {i: h for i, h in self.hashes.items() if (Path(DATA_DIR) / i / "video.mp4").exists()}
+        self.videos = {}
+        for video_id, content_hash in self.hashes.items():
+            self.videos.setdefault(content_hash, video_id)
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump({"hashes": self.hashes, "access": self.access}, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def touch(self, video_id: str):
+        self.access[str(video_id)] = time.time()
+
+    def find_video(self, content_hash: str) -> Optional[str]:
+        return self.videos.get(content_hash)
+
+    def add_video(self, content_hash: str, video_id: str):
+        # several directories hold the same video when it is analysed with different options
+        video_id = str(video_id)
+        self.videos.setdefault(content_hash, video_id)
+        self.hashes[video_id] = content_hash
+        self.touch(video_id)
+
+    def content_of(self, video_id: str) -> str:
+        return self.hashes.get(str(video_id), f"id:{video_id}")
+
+    def select_evicted(self, protected: Iterable[str]) -> List[str]:
+        # picks the least recently used directories to remove and forgets them, the files are removed by `remove`
+        protected = set(map(str, protected))
+        data_dir = Path(DATA_DIR)
+        sizes = {path.name: dir_size(path) for path in data_dir.iterdir() if path.is_dir()}
+        total = sum(sizes.values())
+        if total <= self.max_size:
+            return []
+
+        evicted = []
+        candidates = sorted((name for name in sizes if name not in protected), key=lambda n: self.access.get(n, 0))
+        for name in candidates:
+            if total <= self.max_size:
+                break
+            total -= sizes[name]
+            evicted.append(name)
+            self.access.pop(name, None)
+            content_hash = self.hashes.pop(name, None)
+            if content_hash is not None and self.videos.get(content_hash) == name:
+                del self.videos[content_hash]
+                others = [i for i, h in self.hashes.items() if h == content_hash]
+                if len(others) > 0:
+                    self.videos[content_hash] = others[0]
+        return evicted
+
+    @staticmethod
+    def remove(video_ids: Iterable[str]):
+        for video_id in video_ids:
+            shutil.rmtree(Path(DATA_DIR) / video_id, ignore_errors=True)
+            print(f"[Cache] Evict {video_id}")
+
+
+result_cache = ResultCache()
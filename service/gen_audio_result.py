@@ -1,123 +1,176 @@
 import pathlib
-from collections import OrderedDict
+from collections import defaultdict
+from typing import List, Optional, Tuple
 
 import librosa
 import numpy as np
-import pandas as pd
 import torch
-from pydub import AudioSegment
-from starlette.websockets import WebSocket
 from torch.autograd import Variable
 
 from model.audio_head import get_audio_model, get_trill_model
+from util.audio import load_audio
+from util.columnar import ResultWriter
 from util.consts import DEVICE, SEGMENT_STRIDE, SEGMENT_DURATION, REQUIRED_SAMPLE_RATE, COMMUNICATION_AUDIO_STEP
-from util.label_space_mapping import bold_to_main, bold_to_main_valence, bold_to_main_arousal
+from util.label_space_mapping import bold_to_main_batch, bold_to_main_va
+from util.metrics import span
+from util.profiles import autocast, get_profile
+from util.progress import ProgressChannel
 
 
-def get_emotion_features_from_audio(audio, original_sample_rate):
+def get_emotion_features_from_audios(audios):
+    # audios: 16 kHz mono float32 windows, all of them go through `AudioDnn` as one [N, 512] batch
     audio_model = get_audio_model()
-    features = extract_trill_features(audio, original_sample_rate)
+    with span("audio.trill", items=len(audios)):
+        features = extract_trill_features_batch(audios)
 
-    with torch.no_grad():
+    with torch.no_grad(), autocast(), span("audio.dnn", items=len(audios)):
         features = Variable(features).to(DEVICE)
         output_dis, output_con, output_feat = audio_model(features.float())
 
-        output_emo = output_dis.cpu().detach().numpy()
-        output_con = output_con.cpu().detach().numpy()
+        output_emo = output_dis.float().cpu().detach().numpy()
+        output_con = output_con.float().cpu().detach().numpy()
         output_valence = output_con[:, 0]
         output_arousal = output_con[:, 1]
-        pen_features = output_feat.cpu().detach().numpy()
+        pen_features = output_feat.float().cpu().detach().numpy()
 
         return output_valence, output_arousal, output_emo, pen_features
 
 
-def extract_trill_features(audio, original_sample_rate):
-    module = get_trill_model()
+def to_trill_samples(audio, original_sample_rate):
+    # int16 samples at `original_sample_rate` to the 16 kHz float32 input of TRILL
     float_audio = audio.astype(np.float32) / np.iinfo(np.int16).max
     if original_sample_rate != REQUIRED_SAMPLE_RATE:
         float_audio = librosa.core.resample(
             float_audio.T, orig_sr=original_sample_rate, target_sr=REQUIRED_SAMPLE_RATE,
             res_type='kaiser_best')
-    float_audio = float_audio.flatten()
-    emb_dict = module(samples=float_audio, sample_rate=16000)
-    emb = emb_dict['embedding']
-    emb.shape.assert_is_compatible_with([None, 512])
-    feat = np.average(emb, axis=0)
-    feat = torch.as_tensor(np.array(feat).astype('float'))
-    # add a dimension to act as batch dimension
-    feat = torch.unsqueeze(feat, 0)
-    return feat
-
-
-async def process_audio_file(file_path: str, result_path: str, socket: WebSocket):
-    clip = AudioSegment.from_file(file_path)
-    orig_sampling_rate = clip.frame_rate
-
-    data = OrderedDict()
-
-    arange_iter = np.arange(0.0, clip.duration_seconds, SEGMENT_STRIDE)
-
-    for (n, i) in enumerate(arange_iter):
-        start_time = int(i * 1000)
-        end_time = int(min(i + SEGMENT_DURATION, clip.duration_seconds) * 1000)
-
-        segment = clip[start_time:end_time]
-        # pass audio segment to audio based model
-        # get ndarray from AudioSegment object
-        audio_array = np.array(segment.get_array_of_samples())
-        audio_features = get_emotion_features_from_audio(audio_array, orig_sampling_rate)
-        audio_valence, audio_arousal, audio_emotion, _ = audio_features
-
-        # Mapping audio outputs to the main label space
-        main_audio_emo_prob = bold_to_main(audio_emotion[0])
-        main_audio_valence = bold_to_main_valence(audio_valence[0])
-        main_audio_arousal = bold_to_main_arousal(audio_arousal[0])
-        result = np.array([main_audio_arousal, main_audio_valence, *main_audio_emo_prob])
-
-        start_time = start_time / 1000
-        end_time = end_time / 1000
-        mid_time = start_time + SEGMENT_STRIDE
-        if mid_time < clip.duration_seconds:
-            if (start_time, mid_time) in data:
-                data[(start_time, mid_time)].append(result)
-            else:
-                data[(start_time, mid_time)] = [result]
-
-            if (mid_time, end_time) in data:
-                data[(mid_time, end_time)].append(result)
-            else:
-                data[(mid_time, end_time)] = [result]
-        else:
-            if (start_time, end_time) in data:
-                data[(start_time, end_time)].append(result)
-            else:
-                data[(start_time, end_time)] = [result]
-
-        if (n + 1) % COMMUNICATION_AUDIO_STEP == 0:
-            await socket.send_json({"status": "audio", "data": {"current": n, "total": len(arange_iter)}})
-            await socket.receive_text()
-
-    df = []
-
-    for key, value in data.items():
-        value = np.stack(value, axis=0).mean(axis=0)
-        value[2:] = value[2:] / value[2:].sum()
-        df.append({
-            "start": key[0],
-            "end": key[1],
-            "valence": value[1],
-            "arousal": value[0],
-            "emotion0": value[2],
-            "emotion1": value[3],
-            "emotion2": value[4],
-            "emotion3": value[5],
-            "emotion4": value[6],
-            "emotion5": value[7],
-            "emotion6": value[8],
-            "emotion7": value[9],
-            "emotion8": value[10],
-        })
-
-    pathlib.Path(result_path).parent.mkdir(exist_ok=True, parents=True)
-    pd.DataFrame(df).to_csv(result_path, index=False)
+    return float_audio.flatten()
+
+
+def get_emotion_features_from_audio(audio, original_sample_rate):
+    return get_emotion_features_from_audios([to_trill_samples(audio, original_sample_rate)])
+
+
+def trill_embeddings(module, samples):
+    # samples: list of equal-length windows, returns the time-averaged [N, 512] embeddings
+    if len(samples) > 1:
+        emb = np.asarray(module(samples=np.stack(samples), sample_rate=REQUIRED_SAMPLE_RATE)['embedding'])
+        if emb.ndim == 3:
+            return emb.mean(axis=1)
+
+    # single window, or a module version without batch support
+    feats = []
+    for float_audio in samples:
+        emb_dict = module(samples=float_audio, sample_rate=REQUIRED_SAMPLE_RATE)
+        emb = emb_dict['embedding']
+        emb.shape.assert_is_compatible_with([None, 512])
+        feats.append(np.average(emb, axis=0))
+    return np.stack(feats)
+
+
+def extract_trill_features_batch(samples):
+    module = get_trill_model()
+
+    # the windows have the same length except at the end of the clip, so group them by length for TRILL
+    by_length = defaultdict(list)
+    for k, float_audio in enumerate(samples):
+        by_length[len(float_audio)].append(k)
+
+    feat = np.zeros((len(samples), 512))
+    for indices in by_length.values():
+        feat[indices] = trill_embeddings(module, [samples[k] for k in indices])
+    return torch.as_tensor(feat)
+
+
+def extract_trill_features(audio, original_sample_rate):
+    return extract_trill_features_batch([to_trill_samples(audio, original_sample_rate)])
+
+
+def audio_windows(duration_seconds: float, segment_duration: float = SEGMENT_DURATION,
+    segment_stride: float = SEGMENT_STRIDE
+) -> Tuple[np.ndarray, np.ndarray]:
+    # start and end in ms of the analysed windows, the last ones are cut at the end of the track
+    starts = np.arange(0.0, duration_seconds, segment_stride)
+    ends = np.minimum(starts + segment_duration, duration_seconds)
+    return (starts * 1000).astype(np.int64), (ends * 1000).astype(np.int64)
+
+
+def overlap_bins(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # The output segments are the intervals between consecutive window boundaries, e.g. the half windows when the
+    # windows overlap by half. The starts and the ends of the windows are both sorted, so the windows covering a
+    # segment are a contiguous range [first, last]. Returns the start, end, first and last window of the covered
+    # segments, `last` is non-decreasing.
+    edges = np.unique(np.concatenate([starts, ends]))
+    first = np.searchsorted(ends, edges[1:], side="left")
+    last = np.searchsorted(starts, edges[:-1], side="right") - 1
+    covered = last >= first
+    return edges[:-1][covered], edges[1:][covered], first[covered], last[covered]
+
+
+def _audio_rows(bin_starts: np.ndarray, bin_ends: np.ndarray, values: np.ndarray) -> List[dict]:
+    # values: [N, 11] mean (arousal, valence, 9 emotions) of each segment
+    emotions = values[:, 2:] / values[:, 2:].sum(axis=1, keepdims=True)
+    return [{
+        "start": bin_start / 1000,
+        "end": bin_end / 1000,
+        "valence": value[1],
+        "arousal": value[0],
+        "emotion0": emotion[0],
+        "emotion1": emotion[1],
+        "emotion2": emotion[2],
+        "emotion3": emotion[3],
+        "emotion4": emotion[4],
+        "emotion5": emotion[5],
+        "emotion6": emotion[6],
+        "emotion7": emotion[7],
+        "emotion8": emotion[8],
+    } for bin_start, bin_end, value, emotion in zip(bin_starts, bin_ends, values, emotions)]
+
+
+def process_audio_file(file_path: str, result_path: str, progress: ProgressChannel,
+    audio: Optional[np.ndarray] = None, segment_duration: float = SEGMENT_DURATION,
+    segment_stride: float = SEGMENT_STRIDE
+):
+    # the track is decoded to 16 kHz once, or given when it is shared with ASR, the overlapping windows are views
+    # into it
+    if audio is None:
+        with span("audio.decode"):
+            audio = load_audio(file_path, REQUIRED_SAMPLE_RATE)
+    duration_seconds = len(audio) / REQUIRED_SAMPLE_RATE
+    samples_per_ms = REQUIRED_SAMPLE_RATE // 1000
+
+    starts, ends = audio_windows(duration_seconds, segment_duration, segment_stride)
+    bin_starts, bin_ends, first, last = overlap_bins(starts, ends)
+    n_windows = len(starts)
+
+    # running sums of the window results, the mean of the windows covering a segment is the difference of two of
+    # them divided by the number of windows
+    sums = np.zeros((n_windows + 1, 11))
+    written = 0
+
+    batch_size = get_profile()["audio_batch_size"]
+    with ResultWriter(result_path) as writer:
+        for batch_start in range(0, n_windows, batch_size):
+            batch_end = min(batch_start + batch_size, n_windows)
+            # pass audio segments to audio based model
+            audio_arrays = [audio[start_time * samples_per_ms:end_time * samples_per_ms]
+                for start_time, end_time in zip(starts[batch_start:batch_end], ends[batch_start:batch_end])]
+            audio_valence, audio_arousal, audio_emotion, _ = get_emotion_features_from_audios(audio_arrays)
+            # Mapping audio outputs to the main label space, rows of (arousal, valence, 9 emotions)
+            results = np.column_stack([
+                bold_to_main_va(audio_arousal), bold_to_main_va(audio_valence), bold_to_main_batch(audio_emotion)
+            ])
+            sums[batch_start + 1:batch_end + 1] = sums[batch_start] + np.cumsum(results, axis=0)
+
+            # the segments whose covering windows have all been analysed
+            complete = int(np.searchsorted(last, batch_end - 1, side="right"))
+            if complete > written:
+                segments = slice(written, complete)
+                counts = (last[segments] - first[segments] + 1)[:, None]
+                values = (sums[last[segments] + 1] - sums[first[segments]]) / counts
+                writer.write(_audio_rows(bin_starts[segments], bin_ends[segments], values))
+                written = complete
+
+            if batch_end // COMMUNICATION_AUDIO_STEP > batch_start // COMMUNICATION_AUDIO_STEP:
+                progress.send("audio", {"current": batch_end - 1, "total": n_windows, **writer.status()})
+
     print(f"[Audio Head] Process {pathlib.Path(file_path).parent.name}")
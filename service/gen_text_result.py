@@ -1,58 +1,92 @@
 import json
 import pathlib
+from typing import List, Optional, Sequence
 
-import pandas as pd
-from starlette.websockets import WebSocket
+import numpy as np
+import torch
 
-from model.linguistic_head import get_tokenizer_zh, get_linguistic_model_zh, get_tokenizer_en, predict_emotion_en, \
+from model.linguistic_head import get_tokenizer_zh, get_linguistic_model_zh, get_tokenizer_en, predict_emotions_en, \
     get_linguistic_model_en
-from util.consts import DEVICE
-from util.label_space_mapping import bold_to_main, bold_to_main_valence, bold_to_main_arousal
-
-
-def get_results_from_text_zh(msg):
+from util.columnar import ResultWriter
+from util.consts import DEVICE, TEXT_MAX_LENGTH, TEXT_CHUNK_SEGMENTS
+from util.label_space_mapping import bold_to_main_batch, bold_to_main_va
+from util.metrics import span
+from util.misc import chunked
+from util.profiles import autocast, get_profile
+from util.progress import ProgressChannel
+
+
+def tokenize_by_length(tokenizer, msgs: Sequence[str], batch_size: Optional[int] = None):
+    # Tokenizes all the messages at once and yields (indices, padded batch) with the messages sorted by token
+    # length, so each batch is only padded to the longest of similar-length messages
+    if len(msgs) == 0:
+        return
+    if batch_size is None:
+        batch_size = get_profile()["text_batch_size"]
+    with span("text.tokenize", items=len(msgs)):
+        encodings = tokenizer(list(msgs), truncation=True, max_length=TEXT_MAX_LENGTH)
+    order = np.argsort([len(input_ids) for input_ids in encodings["input_ids"]], kind="stable")
+    for indices in chunked(order.tolist(), batch_size):
+        with span("text.pad", items=len(indices)):
+            batch = tokenizer.pad({key: [value[k] for k in indices] for key, value in encodings.items()},
+                return_tensors="pt").to(DEVICE)
+        yield indices, batch
+
+
+def get_results_from_texts_zh(msgs: Sequence[str]):
     tokenizer = get_tokenizer_zh()
-    tokenized_text = tokenizer([msg], return_tensors="pt", padding=True)
     linguistic_model = get_linguistic_model_zh()
-    tokenized_text = tokenized_text.to(DEVICE)
-    if tokenized_text["input_ids"].shape[1] > 512:
-        tokenized_text["input_ids"] = tokenized_text["input_ids"][:, :512]
-        tokenized_text["token_type_ids"] = tokenized_text["token_type_ids"][:, :512]
-        tokenized_text["attention_mask"] = tokenized_text["attention_mask"][:, :512]
-    output_valence, output_arousal, output_emo, _ = linguistic_model(tokenized_text)
 
-    output_emo = output_emo.softmax(dim=1).cpu().detach().numpy()
-    output_valence = output_valence.cpu().detach().numpy()
-    output_arousal = output_arousal.cpu().detach().numpy()
+    emo_probs = np.zeros((len(msgs), 9))
+    valences = np.zeros(len(msgs))
+    arousals = np.zeros(len(msgs))
+    for indices, tokenized_text in tokenize_by_length(tokenizer, msgs):
+        with torch.no_grad(), autocast(), span("text.encode", items=len(indices)):
+            output_valence, output_arousal, output_emo, _ = linguistic_model(tokenized_text)
 
-    # Mapping linguistic outputs to main label space
-    main_linguistic_emo_prob = bold_to_main(output_emo[0])
-    main_linguistic_valence = bold_to_main_valence(output_valence[0])
-    main_linguistic_arousal = bold_to_main_arousal(output_arousal[0])
+        output_emo = output_emo.float().softmax(dim=1).cpu().detach().numpy()
+        output_valence = output_valence.float().cpu().detach().numpy()
+        output_arousal = output_arousal.float().cpu().detach().numpy()
 
-    return main_linguistic_emo_prob, main_linguistic_valence, main_linguistic_arousal
+        # Mapping linguistic outputs to main label space
+        emo_probs[indices] = bold_to_main_batch(output_emo)
+        valences[indices] = bold_to_main_va(output_valence[:, 0])
+        arousals[indices] = bold_to_main_va(output_arousal[:, 0])
 
+    return emo_probs, valences, arousals
 
-def get_results_from_text_en(msg):
+
+def get_results_from_texts_en(msgs: Sequence[str]):
     tokenizer = get_tokenizer_en()
-    tokenized_text = tokenizer([msg], return_tensors="pt", padding=True)
     linguistic_model = get_linguistic_model_en()
-    tokenized_text = tokenized_text.to(DEVICE)
-    if tokenized_text["input_ids"].shape[1] > 512:
-        tokenized_text["input_ids"] = tokenized_text["input_ids"][:, :512]
-        tokenized_text["token_type_ids"] = tokenized_text["token_type_ids"][:, :512]
-        tokenized_text["attention_mask"] = tokenized_text["attention_mask"][:, :512]
-    output_valence, output_arousal = linguistic_model(tokenized_text)
 
-    output_valence = output_valence.cpu().detach().numpy()[0, 0]
-    output_arousal = output_arousal.cpu().detach().numpy()[0, 0]
+    valences = np.zeros(len(msgs))
+    arousals = np.zeros(len(msgs))
+    for indices, tokenized_text in tokenize_by_length(tokenizer, msgs):
+        with torch.no_grad(), autocast(), span("text.encode", items=len(indices)):
+            output_valence, output_arousal = linguistic_model(tokenized_text)
 
-    # Mapping linguistic outputs to main label space
-    main_linguistic_valence = output_valence * 1000
-    main_linguistic_arousal = output_arousal * 1000
-    main_linguistic_emo_prob = predict_emotion_en(msg)
+        # Mapping linguistic outputs to main label space
+        valences[indices] = output_valence.float().cpu().detach().numpy()[:, 0] * 1000
+        arousals[indices] = output_arousal.float().cpu().detach().numpy()[:, 0] * 1000
 
-    return main_linguistic_emo_prob, main_linguistic_valence, main_linguistic_arousal
+    # the emotion pipeline pads each batch itself, so it gets the messages in the same length order
+    order = np.argsort([len(msg) for msg in msgs], kind="stable")
+    emo_probs = np.zeros((len(msgs), 9))
+    with span("text.emotion", items=len(msgs)):
+        emo_probs[order] = predict_emotions_en([msgs[k] for k in order], batch_size=get_profile()["text_batch_size"])
+
+    return emo_probs, valences, arousals
+
+
+def get_results_from_text_zh(msg):
+    emo_probs, valences, arousals = get_results_from_texts_zh([msg])
+    return emo_probs[0], valences[0], arousals[0]
+
+
+def get_results_from_text_en(msg):
+    emo_probs, valences, arousals = get_results_from_texts_en([msg])
+    return emo_probs[0], valences[0], arousals[0]
 
 
 def get_results_with_lang(lang):
@@ -64,41 +98,51 @@ def get_results_with_lang(lang):
         raise ValueError("Language not supported")
 
 
-async def process_text_file(file_path: str, result_path: str, lang: str, socket: WebSocket):
+def get_batch_results_with_lang(lang):
+    if lang == "zh":
+        return get_results_from_texts_zh
+    elif lang == "en":
+        return get_results_from_texts_en
+    else:
+        raise ValueError("Language not supported")
+
+
+def process_text_file(file_path: str, result_path: str, lang: str, progress: ProgressChannel):
     with open(file_path, "r", encoding="UTF-8") as f:
         input_text = json.load(f)
 
-    df = []
-
-    total = len(input_text["segments"])
-
-    for (i, segment) in enumerate(input_text["segments"]):
-        start = segment["start"]
-        end = segment["end"]
-        msg = segment["text"].strip()
-        # pass msg to text model
-        main_linguistic_emo_prob, main_linguistic_valence, main_linguistic_arousal = get_results_with_lang(lang)(msg)
-        main_linguistic_emo_prob = main_linguistic_emo_prob / main_linguistic_emo_prob.sum()
-        df.append({
-            "start": start,
-            "end": end,
-            "valence": main_linguistic_valence,
-            "arousal": main_linguistic_arousal,
-            "emotion0": main_linguistic_emo_prob[0],
-            "emotion1": main_linguistic_emo_prob[1],
-            "emotion2": main_linguistic_emo_prob[2],
-            "emotion3": main_linguistic_emo_prob[3],
-            "emotion4": main_linguistic_emo_prob[4],
-            "emotion5": main_linguistic_emo_prob[5],
-            "emotion6": main_linguistic_emo_prob[6],
-            "emotion7": main_linguistic_emo_prob[7],
-            "emotion8": main_linguistic_emo_prob[8],
-        })
-
-        # if (i + 1) % COMMUNICATION_LINGUISTIC_STEP == 0:
-        #     await socket.send_json({"status": "text", "data": {"current": i, "total": total}})
-        #     await socket.receive_text()
-
-    pathlib.Path(result_path).parent.mkdir(exist_ok=True, parents=True)
-    pd.DataFrame(df).to_csv(result_path, index=False)
+    segments = input_text["segments"]
+    total = len(segments)
+    get_results = get_batch_results_with_lang(lang)
+
+    with ResultWriter(result_path) as writer:
+        # the segments go through the text model in chunks, so the rows are written in order while the
+        # transcript is processed, each chunk is batched by length
+        for chunk_start in range(0, total, TEXT_CHUNK_SEGMENTS):
+            chunk = segments[chunk_start:chunk_start + TEXT_CHUNK_SEGMENTS]
+            msgs: List[str] = [segment["text"].strip() for segment in chunk]
+            emo_probs, valences, arousals = get_results(msgs)
+            emo_probs = emo_probs / emo_probs.sum(axis=1, keepdims=True)
+
+            for i, segment in enumerate(chunk):
+                main_linguistic_emo_prob = emo_probs[i]
+                writer.write([{
+                    "start": segment["start"],
+                    "end": segment["end"],
+                    "valence": valences[i],
+                    "arousal": arousals[i],
+                    "emotion0": main_linguistic_emo_prob[0],
+                    "emotion1": main_linguistic_emo_prob[1],
+                    "emotion2": main_linguistic_emo_prob[2],
+                    "emotion3": main_linguistic_emo_prob[3],
+                    "emotion4": main_linguistic_emo_prob[4],
+                    "emotion5": main_linguistic_emo_prob[5],
+                    "emotion6": main_linguistic_emo_prob[6],
+                    "emotion7": main_linguistic_emo_prob[7],
+                    "emotion8": main_linguistic_emo_prob[8],
+                }])
+
+            writer.flush()
+            progress.send("text", {"current": chunk_start + len(chunk) - 1, "total": total, **writer.status()})
+
     print(f"[Linguistic Head] Process {pathlib.Path(file_path).parent.name}")
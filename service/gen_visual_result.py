@@ -1,78 +1,150 @@
 import pathlib
-from math import ceil
+from typing import Optional
 
 import numpy as np
-import pandas as pd
-from moviepy.editor import VideoFileClip
-from starlette.websockets import WebSocket
 from tqdm.auto import tqdm
 
-from model.face_detector import detect_face
-from model.visual_head import predict_emotions, get_video_model
+from model.face_detector import detect_face, detect_faces
+from model.visual_head import predict_emotions_batch, get_video_model
+from util.columnar import ResultWriter
 from util.consts import COMMUNICATION_VISUAL_STEP
-from util.label_space_mapping import affectnet_to_main, affectnet_to_main_valence, affectnet_to_main_arousal
+from util.face_tracking import FaceRowInterpolator, FaceTracker
+from util.label_space_mapping import affectnet_to_main_batch, affectnet_to_main_va
+from util.metrics import span, timed_iter
+from util.misc import chunked
+from util.profiles import get_profile
+from util.progress import ProgressChannel
+from util.video import FrameReader
 
 
-async def process_video_file(file_path: str, result_path: str, socket: WebSocket):
+def predict_faces(video_model, faces, scale_x: float = 1.0, scale_y: float = 1.0):
+    # faces: list of (frame index, face id, bounding box, box probability, face crop) collected over several frames.
+    # The boxes are in the decoded resolution and are written in the resolution of the video.
+    with span("visual.emotion", items=len(faces)):
+        scores = predict_emotions_batch(video_model, [face_img for *_, face_img in faces])
+
+    # the whole batch is mapped to the main label space at once
+    emotion_probs = affectnet_to_main_batch(scores, normalize=True)
+    valences = affectnet_to_main_va(scores[:, 8])
+    arousals = affectnet_to_main_va(scores[:, 9])
+    # the faces store them as integers, which a NaN score cannot be converted to
+    if not (np.all(np.isfinite(valences)) and np.all(np.isfinite(arousals))):
+        raise ValueError('The predicted valence or arousal score is not valid')
+    valences, arousals = valences.astype(int), arousals.astype(int)
+
+    results = []
+    for (i, face_id, (x1, y1, x2, y2), prob, _), emotion_prob, valance, arousal in zip(faces, emotion_probs,
+        valences, arousals
+    ):
+        x1, x2 = int(x1 * scale_x), int(x2 * scale_x)
+        y1, y2 = int(y1 * scale_y), int(y2 * scale_y)
+        results.append({
+            "frame": i,
+            "face_id": face_id,
+            "x1": x1,
+            "y1": y1,
+            "x2": x2,
+            "y2": y2,
+            "box_prob": prob,
+            "emotion0": emotion_prob[0],
+            "emotion1": emotion_prob[1],
+            "emotion2": emotion_prob[2],
+            "emotion3": emotion_prob[3],
+            "emotion4": emotion_prob[4],
+            "emotion5": emotion_prob[5],
+            "emotion6": emotion_prob[6],
+            "emotion7": emotion_prob[7],
+            "emotion8": emotion_prob[8],
+            "valence": valance,
+            "arousal": arousal,
+        })
+    return results
+
+
+def track_faces(frames, tracker: FaceTracker, track: bool):
+    # yields (frame index, frame, faces) for the analysed frames. Without tracking every frame is detected in
+    # chunks of `detection_batch_size`, with tracking MTCNN only runs when the tracker asks for a new detection.
+    if track:
+        for i, frame in frames:
+            with span("visual.track"):
+                faces = tracker.propagate(frame)
+            if faces is None:
+                with span("visual.detect"):
+                    faces = tracker.update(frame, *detect_face(frame))
+            yield i, frame, faces
+    else:
+        for chunk in chunked(frames, get_profile()["detection_batch_size"]):
+            with span("visual.detect", items=len(chunk)):
+                detections = detect_faces([frame for _, frame in chunk])
+            for (i, frame), (bounding_boxes, probs) in zip(chunk, detections):
+                yield i, frame, tracker.update(frame, bounding_boxes, probs)
+
+
+def get_frame_stride(fps: float, frame_stride: int = 1, analysis_fps: Optional[float] = None) -> int:
+    if analysis_fps is not None:
+        return max(1, round(fps / analysis_fps))
+    return max(1, frame_stride)
+
+
+def process_video_file(file_path: str, result_path: str, progress: ProgressChannel, frame_stride: int = 1,
+    analysis_fps: Optional[float] = None, track: bool = False
+):
 
     video_model = get_video_model()
+    profile = get_profile()
+
+    # the detection chunks keep up to `detection_batch_size` decoded frames alive
+    reader = FrameReader(file_path, max_side=profile["decode_max_side"], hold=profile["detection_batch_size"])
+    with ResultWriter(result_path) as writer:
+        # face crops waiting for the emotion model, flushed every `visual_batch_size` faces, and the analysed frames
+        # they cover
+        pending_faces = []
+        pending_frames = []
+        total = reader.total
+        stride = get_frame_stride(reader.fps, frame_stride, analysis_fps)
+        # only every `stride`-th frame is decoded
+        reader.stride = stride
+        progress_step = 0
+        last_frame = -1
+        tracker = FaceTracker(track=track)
+        # the frames in between the analysed ones are interpolated as soon as the next analysed frame is known
+        interpolator = FaceRowInterpolator(stride - 1) if stride > 1 else None
+
+        def write_faces(faces, frames):
+            rows = predict_faces(video_model, faces, reader.scale_x, reader.scale_y) if len(faces) > 0 else []
+            writer.write(interpolator.feed(frames, rows) if interpolator is not None else rows)
+
+        progress.send("visual start", {"fps": reader.fps, "stride": stride})
 
-    with VideoFileClip(file_path) as clip:
-        results = []
-        total = ceil(clip.fps * clip.duration)
-
-        await socket.send_json({"status": "visual start", "data": {"fps": clip.fps}})
-        await socket.receive_text()
-
-        for i, frame in enumerate(tqdm(clip.iter_frames(), total=total)):
-            try:
-                bounding_boxes, probs = detect_face(frame)
-
-                for j, bbox in enumerate(bounding_boxes):
-                    prob = probs[j]
-                    box = bbox.astype(int)
-                    x1, y1, x2, y2 = box[0:4]
-                    face_img = frame[max(0, y1):y2, max(0, x1):x2]
-                    if len(face_img) != 0:
-                        _, scores = predict_emotions(video_model, face_img)
-                        valance = scores[8]
-                        arousal = scores[9]
-
-                        emotion_prob = affectnet_to_main(scores)
-
-                        valance = int(affectnet_to_main_valence(valance))
-                        arousal = int(affectnet_to_main_arousal(arousal))
-
-                        emotion_prob = emotion_prob / np.sum(emotion_prob)
-
-                        results.append({
-                            "frame": i,
-                            "x1": x1,
-                            "y1": y1,
-                            "x2": x2,
-                            "y2": y2,
-                            "box_prob": prob,
-                            "emotion0": emotion_prob[0],
-                            "emotion1": emotion_prob[1],
-                            "emotion2": emotion_prob[2],
-                            "emotion3": emotion_prob[3],
-                            "emotion4": emotion_prob[4],
-                            "emotion5": emotion_prob[5],
-                            "emotion6": emotion_prob[6],
-                            "emotion7": emotion_prob[7],
-                            "emotion8": emotion_prob[8],
-                            "valence": valance,
-                            "arousal": arousal,
-                        })
+        # the decode span is the time the head waits for the reader thread
+        frames = timed_iter("visual.decode", tqdm(reader, total=len(reader)))
+        for i, frame, faces in track_faces(frames, tracker, track):
+            with span("visual.crop", items=len(faces)):
+                for face in faces:
+                    x1, y1, x2, y2 = face.box.astype(int)
+                    # copied, the frame buffer is reused by the reader
+                    face_img = frame[max(0, y1):y2, max(0, x1):x2].copy()
+                    if face_img.size != 0:
+                        pending_faces.append((i, face.face_id, (x1, y1, x2, y2), face.prob, face_img))
                     else:
                         print(i, ":", "No face")
-            except Exception as e:
-                raise e
 
-            if (i + 1) % COMMUNICATION_VISUAL_STEP == 0:
-                await socket.send_json({"status": "visual", "data": {"current": i, "total": total}})
-                await socket.receive_text()
+            pending_frames.append(i)
+            if len(pending_faces) >= profile["visual_batch_size"]:
+                write_faces(pending_faces, pending_frames)
+                pending_faces = []
+                pending_frames = []
+
+            last_frame = i
+            if (i + 1) // COMMUNICATION_VISUAL_STEP > progress_step:
+                progress_step = (i + 1) // COMMUNICATION_VISUAL_STEP
+                progress.send("visual", {"current": i, "total": total, **writer.status()})
+
+        if len(pending_frames) > 0:
+            write_faces(pending_faces, pending_frames)
+
+        if interpolator is not None:
+            # the frames decoded after the last analysed one are held as well
+            writer.write(interpolator.close(min(last_frame + stride - 1, total - 1)))
 
-    pathlib.Path(result_path).parent.mkdir(exist_ok=True, parents=True)
-    pd.DataFrame(results).to_csv(result_path, index=False, sep=",")
     print(f"[Visual Head] Process {pathlib.Path(file_path).parent.name}")
@@ -0,0 +1,361 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+import traceback
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set
+
+from cache import result_cache, result_key
+from pipeline import refine_audio, run_pipeline
+from util.consts import JOB_WORKERS, DATA_DIR, AUDIO_PRESETS, MIN_SEGMENT_DURATION, MAX_SEGMENT_DURATION, \
+    MIN_SEGMENT_STRIDE
+from util.misc import VideoNamePool
+from util.progress import CoalescingQueue
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# state of a job, next to its uploaded video
+JOB_FILE = "job.json"
+
+
+def parse_audio_params(payload: dict) -> dict:
+    # windows of the audio head, from a preset, each value can also be given on its own
+    preset = payload.get("audio_preset", "default")
+    if preset not in AUDIO_PRESETS:
+        raise ValueError(f"Unknown audio_preset {preset}, choose from {', '.join(AUDIO_PRESETS)}")
+    segment_duration, segment_stride = AUDIO_PRESETS[preset]
+
+    segment_duration = float(payload.get("segment_duration", segment_duration))
+    if not MIN_SEGMENT_DURATION <= segment_duration <= MAX_SEGMENT_DURATION:
+        raise ValueError(f"segment_duration should be between {MIN_SEGMENT_DURATION} and {MAX_SEGMENT_DURATION}")
+
+    segment_stride = float(payload.get("segment_stride", segment_stride))
+    if not MIN_SEGMENT_STRIDE <= segment_stride <= segment_duration:
+        raise ValueError(f"segment_stride should be between {MIN_SEGMENT_STRIDE} and segment_duration")
+
+    return {"segment_duration": segment_duration, "segment_stride": segment_stride}
+
+
+def parse_job_params(payload: dict) -> dict:
+    # validates the analysis options sent by the client, shared by `/ws/` and `/api/jobs`
+    lang = payload.get("lang")
+    if lang not in ("en", "zh"):
+        raise ValueError("Language not supported")
+
+    frame_stride = int(payload.get("frame_stride", 1))
+    if frame_stride < 1:
+        raise ValueError("frame_stride should be a positive integer")
+
+    analysis_fps = payload.get("analysis_fps")
+    if analysis_fps is not None:
+        analysis_fps = float(analysis_fps)
+        if analysis_fps <= 0:
+            raise ValueError("analysis_fps should be positive")
+
+    return {
+        "lang": lang,
+        "frame_stride": frame_stride,
+        "analysis_fps": analysis_fps,
+        "track": bool(payload.get("track", False)),
+        **parse_audio_params(payload),
+    }
+
+
+class Job:
+
+    def __init__(self, job_id: str, params: dict, state: str = QUEUED, result: Optional[dict] = None,
+        error: Optional[str] = None, created: Optional[float] = None, updated: Optional[float] = None,
+        key: Optional[str] = None
+    ):
+        self.id = job_id
+        self.params = params
+        # result cache key, from the video content, the model versions and the options
+        self.key = key
+        self.state = state
+        self.result = result
+        self.error = error
+        self.created = created if created is not None else time.time()
+        self.updated = updated if updated is not None else self.created
+        # progress messages so far, replayed to late subscribers
+        self.events: List[dict] = []
+        self.subscribers: Set[CoalescingQueue] = set()
+        # audio windows and latest progress of a running refine of the audio results, not saved
+        self.refining: Optional[dict] = None
+        self.refine_error: Optional[str] = None
+
+    @property
+    def directory(self) -> Path:
+        return Path(DATA_DIR) / self.id
+
+    @property
+    def video_path(self) -> str:
+        return str(self.directory / "video.mp4")
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (DONE, FAILED)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "params": self.params,
+            "key": self.key,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "updated": self.updated,
+        }
+
+    def status(self) -> dict:
+        return {
+            **self.to_dict(),
+            "progress": self.events[-1] if len(self.events) > 0 else None,
+            "refining": self.refining,
+            "refine_error": self.refine_error,
+        }
+
+    def save(self):
+        self.updated = time.time()
+        path = self.directory / JOB_FILE
+        tmp_path = path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "Job":
+        with open(path, "r", encoding="UTF-8") as f:
+            info = json.load(f)
+        return cls(info["id"], info["params"], info["state"], info.get("result"), info.get("error"),
+            info.get("created"), info.get("updated"), info.get("key"))
+
+    async def publish(self, message: dict):
+        if len(self.events) > 0 and self.events[-1]["status"] == message["status"]:
+            # only the latest progress tick of a stage is worth replaying
+            self.events[-1] = message
+        else:
+            self.events.append(message)
+        for queue in self.subscribers:
+            queue.put(message)
+
+    def close_subscribers(self):
+        for queue in self.subscribers:
+            queue.close()
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        # publishing never waits on a subscriber, a slow one skips the stale progress ticks
+        queue = CoalescingQueue()
+        for message in self.events:
+            queue.put(message)
+        if self.finished:
+            queue.close()
+        else:
+            self.subscribers.add(queue)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.subscribers.discard(queue)
+
+
+class JobManager:
+    # Jobs are stored as `job.json` next to the uploaded video and run by a fixed number of workers.
+    # Queued jobs, and jobs interrupted while running, are queued again when the server restarts.
+    # A job is reused by any later submission of the same video content with the same options.
+
+    def __init__(self, num_workers: int = JOB_WORKERS):
+        self.num_workers = num_workers
+        self.jobs: Dict[str, Job] = {}
+        self.by_key: Dict[str, str] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.refines: Set[asyncio.Task] = set()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        data_dir = Path(DATA_DIR)
+        data_dir.mkdir(exist_ok=True, parents=True)
+        pending = []
+        for path in data_dir.glob(f"*/{JOB_FILE}"):
+            try:
+                job = Job.load(path)
+            except (ValueError, KeyError, OSError):
+                print(f"[Jobs] Skip unreadable {path}")
+                continue
+            if job.key is None:
+                job.key = result_key(result_cache.content_of(job.id), job.params)
+            self.jobs[job.id] = job
+            if job.state != FAILED:
+                self.by_key[job.key] = job.id
+            if not job.finished:
+                job.state = QUEUED
+                job.save()
+                pending.append(job)
+
+        for job in sorted(pending, key=lambda j: j.created):
+            self.queue.put_nowait(job.id)
+        if len(pending) > 0:
+            print(f"[Jobs] Resume {len(pending)} job(s)")
+
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.num_workers)]
+
+    async def stop(self):
+        tasks = self.workers + list(self.refines)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        self.refines = set()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(str(job_id))
+
+    def submit(self, job_id: str, params: dict) -> Job:
+        job_id = str(job_id)
+        key = result_key(result_cache.content_of(job_id), params)
+        # a job already queued, running or done for the same content and options is reused, e.g. when the video is
+        # uploaded again or a client reconnects
+        cached = self.jobs.get(self.by_key.get(key))
+        if cached is not None and cached.state != FAILED:
+            result_cache.touch(cached.id)
+            return cached
+
+        job = self.jobs.get(job_id)
+        if job is not None and (job.key != key or job.refining is not None):
+            # the video was analysed with other options or its results are being refined, the new results go to a
+            # directory of their own
+            job_id = self._fork(job_id)
+
+        job = Job(job_id, params, key=key)
+        if not os.path.exists(job.video_path):
+            raise ValueError(f"No uploaded video for {job_id}")
+        job.save()
+        self.jobs[job_id] = job
+        self.by_key[key] = job_id
+        result_cache.touch(job_id)
+        result_cache.save()
+        self.queue.put_nowait(job_id)
+        return job
+
+    def refine(self, job: Job, audio_params: dict) -> Job:
+        # Reruns only the audio head of a finished job with other windows, e.g. the default ones after a preview.
+        # The job stays done meanwhile and its results are replaced once the new ones are complete.
+        if job.state != DONE:
+            raise ValueError(f"Job {job.id} is {job.state}, only finished jobs can be refined")
+        if job.refining is not None:
+            raise ValueError(f"Job {job.id} is already being refined")
+        # the results are about to change, so the submissions with the old options do not attach to this job and a
+        # submission for the same video gets a fork of its own
+        self._unregister(job)
+        job.refining = {**audio_params, "progress": None}
+        job.refine_error = None
+        task = asyncio.create_task(self._refine(job, audio_params))
+        self.refines.add(task)
+        task.add_done_callback(self.refines.discard)
+        return job
+
+    def _unregister(self, job: Job):
+        if self.by_key.get(job.key) == job.id:
+            del self.by_key[job.key]
+
+    def _register(self, job: Job) -> bool:
+        # a key is only taken over from a failed job, never from one queued, running or done
+        owner = self.jobs.get(self.by_key.get(job.key))
+        if owner is not None and owner is not job and owner.state != FAILED:
+            return False
+        self.by_key[job.key] = job.id
+        return True
+
+    async def _refine(self, job: Job, audio_params: dict):
+        async def send(message: dict):
+            job.refining["progress"] = message
+
+        try:
+            await refine_audio(job.video_path, send, **audio_params)
+        except asyncio.CancelledError:
+            # the results were not replaced, the job keeps its options
+            job.refining = None
+            self._register(job)
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            job.refine_error = repr(e)
+            job.refining = None
+            self._register(job)
+            return
+
+        # the results now match the new options, so does the cache key
+        job.params = {**job.params, **audio_params}
+        job.key = result_key(result_cache.content_of(job.id), job.params)
+        if not self._register(job):
+            # a job submitted with the new options in the meantime owns the key, this one stays reachable by its id
+            print(f"[Jobs] {job.id} refined, its options are analysed by job {self.by_key[job.key]}")
+        job.refining = None
+        job.save()
+        result_cache.touch(job.id)
+        result_cache.save()
+
+    def _fork(self, job_id: str) -> str:
+        new_id = str(VideoNamePool.get())
+        src = Path(DATA_DIR) / job_id / "video.mp4"
+        dst = Path(DATA_DIR) / new_id / "video.mp4"
+        dst.parent.mkdir(exist_ok=True, parents=True)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+        content = result_cache.content_of(job_id)
+        if not content.startswith("id:"):
+            result_cache.add_video(content, new_id)
+        return new_id
+
+    def forget(self, job_ids: Iterable[str]):
+        for job_id in job_ids:
+            job = self.jobs.pop(job_id, None)
+            if job is not None and self.by_key.get(job.key) == job_id:
+                del self.by_key[job.key]
+
+    async def evict(self, protected: Iterable[str] = ()):
+        # removes the least recently used analyses over the cache size, never the ones queued, running or refined
+        active = {job.id for job in self.jobs.values() if not job.finished or job.refining is not None}
+        evicted = result_cache.select_evicted(active | set(map(str, protected)))
+        if len(evicted) == 0:
+            return
+        self.forget(evicted)
+        result_cache.save()
+        await asyncio.get_running_loop().run_in_executor(None, result_cache.remove, evicted)
+
+    async def _work(self):
+        while True:
+            job = self.jobs[await self.queue.get()]
+            job.state = RUNNING
+            job.events = []
+            job.save()
+            try:
+                job.result = await run_pipeline(job.video_path, send=job.publish, **job.params)
+                job.state = DONE
+            except asyncio.CancelledError:
+                # server shutdown, the job stays running on disk and is resumed on the next start
+                raise
+            except Exception as e:
+                traceback.print_exc()
+                job.error = repr(e)
+                job.state = FAILED
+            job.save()
+            job.close_subscribers()
+            try:
+                await self.evict()
+            except OSError:
+                traceback.print_exc()
+
+
+job_manager = JobManager()
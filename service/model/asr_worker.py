@@ -0,0 +1,17 @@
+import numpy as np
+import torch
+import whisper
+
+# Entry points of the ASR worker processes, kept out of `text2speech` so a spawned worker only imports Whisper and
+# not the other heads
+_model = None
+
+
+def init_worker(num_threads: int, model_name: str):
+    global _model
+    torch.set_num_threads(num_threads)
+    _model = whisper.load_model(model_name, device="cpu")
+
+
+def transcribe(audio: np.ndarray, lang: str) -> dict:
+    return _model.transcribe(audio, language=lang, fp16=False)
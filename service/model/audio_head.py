@@ -3,7 +3,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from model.registry import registry
 from util.consts import DEVICE, AUDIO_MODEL_PATH
+from util.profiles import quantize
 
 
 class AudioDnn(nn.Module):
@@ -32,25 +34,36 @@ class AudioDnn(nn.Module):
         return x_dis, x_cont, x_pen
 
 
-_module = None
+def load_trill_model():
+    import tensorflow as tf
+    for device in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_virtual_device_configuration(device,
+            [tf.config.experimental.VirtualDeviceConfiguration(memory_limit=3500)])
 
+    return hub.load('https://tfhub.dev/google/nonsemantic-speech-benchmark/trill/3')
 
-def get_trill_model():
-    global _module
-    if _module is None:
-        import tensorflow as tf
-        for device in tf.config.experimental.list_physical_devices('GPU'):
-            tf.config.experimental.set_virtual_device_configuration(device,
-                [tf.config.experimental.VirtualDeviceConfiguration(memory_limit=3500)])
-
-        _module = hub.load('https://tfhub.dev/google/nonsemantic-speech-benchmark/trill/3')
-    return _module
 
-
-def get_audio_model():
+def load_audio_model():
     checkpoint = torch.load(AUDIO_MODEL_PATH, map_location=DEVICE)
     model = AudioDnn()
     model.load_state_dict(checkpoint)
     model = model.to(DEVICE)
     model.eval()
-    return model
+    return quantize(model)
+
+
+def warmup_audio_model(model: AudioDnn):
+    with torch.no_grad():
+        model(torch.zeros(2, 512, device=DEVICE))
+
+
+registry.register("trill", load_trill_model)
+registry.register("audio", load_audio_model, warmup_audio_model)
+
+
+def get_trill_model():
+    return registry.get("trill")
+
+
+def get_audio_model():
+    return registry.get("audio")
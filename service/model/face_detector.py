@@ -1,14 +1,124 @@
+from typing import List
+
+import numpy as np
+import torch
 from facenet_pytorch.models.mtcnn import MTCNN
+from facenet_pytorch.models.utils.detect_face import bbreg, batched_nms_numpy, fixed_batch_process, \
+    generateBoundingBox, imresample, pad, rerec
+from torchvision.ops.boxes import batched_nms
 
+from model.registry import registry
 from util.consts import DEVICE
 
-mtcnn = MTCNN(keep_all=False, post_process=False,
-    min_face_size=40, device=DEVICE)
+registry.register("face_detector", lambda: MTCNN(keep_all=False, post_process=False,
+    min_face_size=40, device=DEVICE))
 
 
-def detect_face(frame, threshold=0.9):
-    bounding_boxes, probs = mtcnn.detect(frame, landmarks=False)
+def get_face_detector() -> MTCNN:
+    return registry.get("face_detector")
+
+
+def _filter_boxes(bounding_boxes, probs, threshold):
     if bounding_boxes is not None:
-        return bounding_boxes[probs > threshold], probs
+        keep = probs > threshold
+        return bounding_boxes[keep], probs[keep]
     else:
         return [], None
+
+
+def detect_face(frame, threshold=0.9):
+    bounding_boxes, probs = get_face_detector().detect(frame, landmarks=False)
+    return _filter_boxes(bounding_boxes, probs, threshold)
+
+
+def _crop_faces(imgs: torch.Tensor, boxes: torch.Tensor, image_inds: torch.Tensor, size: int) -> torch.Tensor:
+    # the normalized [N, 3, size, size] crops of the candidate boxes, input of RNet and ONet
+    y, ey, x, ex = pad(boxes, imgs.shape[3], imgs.shape[2])
+    crops = [
+        imresample(imgs[image_inds[k], :, (y[k] - 1):ey[k], (x[k] - 1):ex[k]].unsqueeze(0), (size, size))
+        for k in range(len(y)) if ey[k] > (y[k] - 1) and ex[k] > (x[k] - 1)
+    ]
+    return (torch.cat(crops, dim=0) - 127.5) * 0.0078125
+
+
+def _detect_batch(detector: MTCNN, frames) -> List[np.ndarray]:
+    # The three stages of facenet_pytorch's `detect_face` on the whole batch, without the landmarks. Its last step
+    # packs the boxes of the frames into one array, which numpy>=1.24 rejects when the frames have different numbers
+    # of faces, so the boxes are split per frame here instead. Returns the [n, 5] boxes and probabilities of each
+    # frame.
+    imgs = torch.as_tensor(np.stack(frames), device=detector.device)
+    imgs = imgs.permute(0, 3, 1, 2).type(next(detector.pnet.parameters()).dtype)
+    h, w = imgs.shape[2:4]
+    threshold = detector.thresholds
+
+    # scale pyramid, down to 12 pixels for the smallest face
+    scales = []
+    scale = 12.0 / detector.min_face_size
+    while min(h, w) * scale >= 12:
+        scales.append(scale)
+        scale *= detector.factor
+
+    # PNet, NMS within each scale and image then within each image
+    boxes, image_inds, scale_picks = [], [], []
+    offset = 0
+    for scale in scales:
+        im_data = imresample(imgs, (int(h * scale + 1), int(w * scale + 1)))
+        reg, probs = detector.pnet((im_data - 127.5) * 0.0078125)
+        boxes_scale, image_inds_scale = generateBoundingBox(reg, probs[:, 1], scale, threshold[0])
+        boxes.append(boxes_scale)
+        image_inds.append(image_inds_scale)
+        scale_picks.append(batched_nms(boxes_scale[:, :4], boxes_scale[:, 4], image_inds_scale, 0.5) + offset)
+        offset += boxes_scale.shape[0]
+    scale_picks = torch.cat(scale_picks, dim=0)
+    boxes, image_inds = torch.cat(boxes, dim=0)[scale_picks], torch.cat(image_inds, dim=0)[scale_picks]
+    pick = batched_nms(boxes[:, :4], boxes[:, 4], image_inds, 0.7)
+    boxes, image_inds = boxes[pick], image_inds[pick]
+
+    regw = boxes[:, 2] - boxes[:, 0]
+    regh = boxes[:, 3] - boxes[:, 1]
+    boxes = rerec(torch.stack([
+        boxes[:, 0] + boxes[:, 5] * regw, boxes[:, 1] + boxes[:, 6] * regh,
+        boxes[:, 2] + boxes[:, 7] * regw, boxes[:, 3] + boxes[:, 8] * regh, boxes[:, 4],
+    ]).permute(1, 0))
+
+    # RNet
+    if len(boxes) > 0:
+        out = fixed_batch_process(_crop_faces(imgs, boxes, image_inds, 24), detector.rnet)
+        score = out[1][:, 1]
+        ipass = score > threshold[1]
+        boxes = torch.cat((boxes[ipass, :4], score[ipass].unsqueeze(1)), dim=1)
+        image_inds, reg = image_inds[ipass], out[0][ipass]
+        pick = batched_nms(boxes[:, :4], boxes[:, 4], image_inds, 0.7)
+        boxes, image_inds = rerec(bbreg(boxes[pick], reg[pick])), image_inds[pick]
+
+    # ONet
+    if len(boxes) > 0:
+        out = fixed_batch_process(_crop_faces(imgs, boxes, image_inds, 48), detector.onet)
+        score = out[2][:, 1]
+        ipass = score > threshold[2]
+        boxes = torch.cat((boxes[ipass, :4], score[ipass].unsqueeze(1)), dim=1)
+        image_inds = image_inds[ipass]
+        boxes = bbreg(boxes, out[0][ipass])
+        pick = batched_nms_numpy(boxes[:, :4], boxes[:, 4], image_inds, 0.7, "Min")
+        boxes, image_inds = boxes[pick], image_inds[pick]
+
+    boxes = boxes.cpu().numpy()
+    image_inds = image_inds.cpu().numpy()
+    return [boxes[image_inds == k] for k in range(len(frames))]
+
+
+def detect_faces(frames, threshold=0.9):
+    # frames: list or array of equal-sized frames, detected in one batched MTCNN pass
+    detector = get_face_detector()
+    with torch.no_grad():
+        batch_boxes = _detect_batch(detector, frames)
+
+    detections = []
+    for boxes in batch_boxes:
+        if len(boxes) == 0:
+            detections.append(_filter_boxes(None, None, threshold))
+            continue
+        # largest first, as `MTCNN.detect` orders them
+        boxes = boxes[np.argsort((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))[::-1]]
+        detections.append(_filter_boxes(boxes[:, :4], boxes[:, 4], threshold))
+    return detections
@@ -10,7 +10,9 @@ from torch.optim import Adam
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from transformers import BertModel, BertTokenizer, pipeline, RobertaTokenizer, RobertaModel
 
+from model.registry import registry
 from util.consts import LINGUISTIC_MODEL_ZH_PATH, DEVICE, LINGUISTIC_MODEL_EN_PATH
+from util.profiles import quantize
 
 
 # English model
@@ -78,69 +80,75 @@ class LinguisticHeadEn(NekoModel):
         }
 
 
-_roberta_en: Optional[BertModel] = None
-_tokenizer_en: Optional[BertTokenizer] = None
-_emotion_model_en: Optional[pipeline] = None
+registry.register("roberta_en", lambda: RobertaModel.from_pretrained("roberta-base"))
+
+
+def load_emotion_model_en():
+    emotion_model = pipeline("text-classification", model="j-hartmann/emotion-english-distilroberta-base", top_k=7)
+    quantize(emotion_model.model)
+    return emotion_model
+
+
+registry.register("emotion_en", load_emotion_model_en)
 
 
 def get_roberta_en() -> BertModel:
-    global _roberta_en
-    if _roberta_en is None:
-        _roberta_en = RobertaModel.from_pretrained("roberta-base")
-    return _roberta_en
+    return registry.get("roberta_en")
 
 
 def get_emotion_model_en():
-    global _emotion_model_en
-    if _emotion_model_en is None:
-        _emotion_model_en = pipeline("text-classification", model="j-hartmann/emotion-english-distilroberta-base",
-            top_k=7)
-    return _emotion_model_en
+    return registry.get("emotion_en")
 
 
-def predict_emotion_en(text: str):
+_EMOTION_EN_INDEX = {
+    "fear": 0,
+    "anger": 1,
+    "joy": 2,
+    "sadness": 3,
+    "disgust": 4,
+    "surprise": 5,
+    "neutral": 8,
+}
+
+
+def _emotion_prob_en(result) -> np.ndarray:
     emo_prob = np.zeros(9)
-    model = get_emotion_model_en()
-    result = model(text)
-    for item in result[0]:
-        if item["label"] == "joy":
-            emo_prob[2] = item["score"]
-        elif item["label"] == "surprise":
-            emo_prob[5] = item["score"]
-        elif item["label"] == "neutral":
-            emo_prob[8] = item["score"]
-        elif item["label"] == "anger":
-            emo_prob[1] = item["score"]
-        elif item["label"] == "sadness":
-            emo_prob[3] = item["score"]
-        elif item["label"] == "disgust":
-            emo_prob[4] = item["score"]
-        elif item["label"] == "fear":
-            emo_prob[0] = item["score"]
-        else:
+    for item in result:
+        if item["label"] not in _EMOTION_EN_INDEX:
             raise ValueError("Unknown emotion")
+        emo_prob[_EMOTION_EN_INDEX[item["label"]]] = item["score"]
     return emo_prob
 
 
-def get_tokenizer_en() -> BertTokenizer:
-    global _tokenizer_en
-    if _tokenizer_en is None:
-        _tokenizer_en = RobertaTokenizer.from_pretrained("roberta-base")
-    return _tokenizer_en
+def predict_emotions_en(texts: Sequence[str], batch_size: int = 1) -> np.ndarray:
+    if len(texts) == 0:
+        return np.zeros((0, 9))
+    model = get_emotion_model_en()
+    results = model(list(texts), batch_size=batch_size, truncation=True)
+    return np.stack([_emotion_prob_en(result) for result in results])
+
 
+def predict_emotion_en(text: str):
+    return predict_emotions_en([text])[0]
 
-_linguistic_model_en = None
 
+def load_linguistic_model_en() -> LinguisticHeadEn:
+    model = LinguisticHeadEn(finetune=False).load_from_checkpoint(LINGUISTIC_MODEL_EN_PATH,
+        strict=False, map_location=DEVICE)
+    # the RoBERTa encoder is quantized with the head
+    return quantize(model.to(DEVICE))
 
-def get_linguistic_model_en() -> LinguisticHeadEn:
-    global _linguistic_model_en
-    if _linguistic_model_en is None:
-        _linguistic_model_en = LinguisticHeadEn(finetune=False).load_from_checkpoint(LINGUISTIC_MODEL_EN_PATH,
-            strict=False, map_location=DEVICE)
-        _linguistic_model_en = _linguistic_model_en.to(DEVICE)
 
-    return _linguistic_model_en
+registry.register("tokenizer_en", lambda: RobertaTokenizer.from_pretrained("roberta-base"))
+registry.register("linguistic_en", load_linguistic_model_en)
+
+
+def get_tokenizer_en() -> BertTokenizer:
+    return registry.get("tokenizer_en")
+
 
+def get_linguistic_model_en() -> LinguisticHeadEn:
+    return registry.get("linguistic_en")
 
 
 # Chinese model
@@ -228,32 +236,24 @@ class LinguisticHeadZh(NekoModel):
         return e_acc
 
 
-_roberta_zh: Optional[BertModel] = None
-_tokenizer_zh: Optional[BertTokenizer] = None
+def load_linguistic_model_zh() -> LinguisticHeadZh:
+    model = LinguisticHeadZh(finetune=False).load_from_checkpoint(LINGUISTIC_MODEL_ZH_PATH,
+        strict=False, map_location=DEVICE)
+    return quantize(model.to(DEVICE))
 
 
-def get_roberta_zh() -> BertModel:
-    global _roberta_zh
-    if _roberta_zh is None:
-        _roberta_zh = BertModel.from_pretrained("hfl/chinese-roberta-wwm-ext-large")
-    return _roberta_zh
+registry.register("roberta_zh", lambda: BertModel.from_pretrained("hfl/chinese-roberta-wwm-ext-large"))
+registry.register("tokenizer_zh", lambda: BertTokenizer.from_pretrained("hfl/chinese-roberta-wwm-ext-large"))
+registry.register("linguistic_zh", load_linguistic_model_zh)
 
 
-def get_tokenizer_zh() -> BertTokenizer:
-    global _tokenizer_zh
-    if _tokenizer_zh is None:
-        _tokenizer_zh = BertTokenizer.from_pretrained("hfl/chinese-roberta-wwm-ext-large")
-    return _tokenizer_zh
+def get_roberta_zh() -> BertModel:
+    return registry.get("roberta_zh")
 
 
-_linguistic_model_zh = None
+def get_tokenizer_zh() -> BertTokenizer:
+    return registry.get("tokenizer_zh")
 
 
 def get_linguistic_model_zh() -> LinguisticHeadZh:
-    global _linguistic_model_zh
-    if _linguistic_model_zh is None:
-        _linguistic_model_zh = LinguisticHeadZh(finetune=False).load_from_checkpoint(LINGUISTIC_MODEL_ZH_PATH,
-            strict=False, map_location=DEVICE)
-        _linguistic_model_zh = _linguistic_model_zh.to(DEVICE)
-
-    return _linguistic_model_zh
+    return registry.get("linguistic_zh")
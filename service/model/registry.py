@@ -0,0 +1,94 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from torch import nn
+
+from util.misc import get_rss
+
+
+def _torch_modules(model: Any) -> Iterable[nn.Module]:
+    # the heads wrap their torch modules in different ways (HSEmotionRecognizer.model, pipeline.model, ...)
+    if isinstance(model, nn.Module):
+        yield model
+    else:
+        inner = getattr(model, "model", None)
+        if isinstance(inner, nn.Module):
+            yield inner
+
+
+def model_size(model: Any) -> Optional[int]:
+    modules = list(_torch_modules(model))
+    if len(modules) == 0:
+        return None
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for module in modules for tensor in [*module.parameters(), *module.buffers()]
+    )
+
+
+class ModelRegistry:
+    # Process-wide store of the models used by the heads. Each model is loaded once, on first use or by
+    # `warmup`, and the load time and memory are recorded for `stats`.
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._warmups: Dict[str, Callable[[Any], None]] = {}
+        self._models: Dict[str, Any] = {}
+        self._stats: Dict[str, dict] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], Any], warmup: Optional[Callable[[Any], None]] = None):
+        self._loaders[name] = loader
+        if warmup is not None:
+            self._warmups[name] = warmup
+        self._locks[name] = threading.Lock()
+
+    @property
+    def names(self):
+        return list(self._loaders.keys())
+
+    def get(self, name: str) -> Any:
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        # one lock per model, loaders may get other models from the registry
+        with self._locks[name]:
+            if name not in self._models:
+                self._models[name] = self._load(name)
+        return self._models[name]
+
+    def _load(self, name: str) -> Any:
+        rss_before = get_rss()
+        start = time.perf_counter()
+        model = self._loaders[name]()
+        load_time = time.perf_counter() - start
+        rss_after = get_rss()
+
+        size = model_size(model)
+        with self._lock:
+            self._stats[name] = {
+                "load_time": load_time,
+                "parameter_bytes": size,
+                "rss_delta": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+            }
+        size_info = f", {size / 1024 ** 2:.1f} MB" if size is not None else ""
+        print(f"[Model Registry] Load {name} in {load_time:.2f}s{size_info}")
+        return model
+
+    def warmup(self, names: Optional[Iterable[str]] = None):
+        for name in names if names is not None else self.names:
+            model = self.get(name)
+            if name in self._warmups:
+                start = time.perf_counter()
+                self._warmups[name](model)
+                self._stats[name]["warmup_time"] = time.perf_counter() - start
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {name: {"loaded": name in self._models, **self._stats.get(name, {})} for name in self.names}
+
+
+registry = ModelRegistry()
@@ -1,20 +1,109 @@
 import whisper
 import json
+import multiprocessing
+import os
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
 
-_model = None
+import numpy as np
+from whisper.audio import HOP_LENGTH
+
+from model import asr_worker
+from model.registry import registry
+from util.audio import load_audio, split_on_voice
+from util.consts import DEVICE, REQUIRED_SAMPLE_RATE, ASR_MODE, ASR_WORKERS
+from util.metrics import span
+from util.profiles import get_profile
+from util.workers import get_inference_workers
+
+registry.register("whisper", lambda: whisper.load_model(get_profile()["whisper_model"], device=DEVICE))
+
+_asr_executor: Optional[ProcessPoolExecutor] = None
 
 
 def get_model():
-    global _model
-    if _model is None:
-        _model = whisper.load_model("base")
-    return _model
+    return registry.get("whisper")
+
+
+def asr_threads() -> int:
+    # ASR runs while the audio and visual heads run on the other workers of the inference pool, so the ASR processes
+    # share the cores of one of these workers
+    budget = max(1, (os.cpu_count() or 1) // get_inference_workers())
+    return max(1, budget // ASR_WORKERS)
+
+
+def get_asr_executor() -> ProcessPoolExecutor:
+    # CPU only, each process loads its own model. Spawned rather than forked, the server already runs torch in
+    # several threads.
+    global _asr_executor
+    if _asr_executor is None:
+        _asr_executor = ProcessPoolExecutor(max_workers=ASR_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+            initializer=asr_worker.init_worker, initargs=(asr_threads(), get_profile()["whisper_model"]))
+    return _asr_executor
+
+
+def shutdown_asr_executor():
+    global _asr_executor
+    if _asr_executor is not None:
+        _asr_executor.shutdown(wait=False, cancel_futures=True)
+        _asr_executor = None
+
+
+def merge_transcripts(results: List[dict], offsets: List[int], lang: str) -> dict:
+    # shifts the segments of the chunk transcripts by the start of their chunk (in samples), in the schema of
+    # `transcribe` on the whole track
+    segments = []
+    for result, offset in zip(results, offsets):
+        seconds = offset / REQUIRED_SAMPLE_RATE
+        for segment in result["segments"]:
+            segment = {
+                **segment,
+                "id": len(segments),
+                "seek": segment["seek"] + offset // HOP_LENGTH,
+                "start": segment["start"] + seconds,
+                "end": segment["end"] + seconds,
+            }
+            if "words" in segment:
+                segment["words"] = [
+                    {**word, "start": word["start"] + seconds, "end": word["end"] + seconds}
+                    for word in segment["words"]
+                ]
+            segments.append(segment)
+
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": lang,
+    }
+
+
+def transcribe_chunks(audio: np.ndarray, lang: str) -> dict:
+    # Whisper only runs on the voiced chunks, in parallel over the ASR pool on CPU
+    with span("text.vad"):
+        chunks = split_on_voice(audio, REQUIRED_SAMPLE_RATE)
+    pieces = [audio[start:end] for start, end in chunks]
+    if DEVICE.type == "cuda":
+        model = get_model()
+        # copied, torch wants writable arrays
+        results = [model.transcribe(np.array(piece), language=lang) for piece in pieces]
+    else:
+        executor = get_asr_executor()
+        results = list(executor.map(asr_worker.transcribe, pieces, [lang] * len(pieces)))
+    return merge_transcripts(results, [start for start, _ in chunks], lang)
+
 
+def text2speech(file_path: str, output_path: str, lang: str, audio: Optional[np.ndarray] = None):
+    # audio: the 16 kHz waveform of the video when another head already decoded it
+    if audio is None:
+        audio = load_audio(file_path, REQUIRED_SAMPLE_RATE)
 
-def text2speech(file_path: str, output_path: str, lang: str):
-    model = get_model()
-    result = model.transcribe(file_path, language=lang)
+    # one item per second of audio
+    with span("text.asr", items=max(1, round(len(audio) / REQUIRED_SAMPLE_RATE))):
+        if ASR_MODE == "vad":
+            result = transcribe_chunks(audio, lang)
+        else:
+            result = get_model().transcribe(np.array(audio), language=lang)
 
     pathlib.Path(output_path).parent.mkdir(exist_ok=True, parents=True)
     with open(output_path, "w", encoding="UTF-8") as f:
@@ -1,6 +1,15 @@
+import numpy as np
+import torch
+from PIL import Image
 from hsemotion.facial_emotions import HSEmotionRecognizer
 
+from model.registry import registry
 from util.consts import DEVICE
+from util.profiles import autocast
+
+# ImageNet statistics used by the HSEmotion test transforms
+_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+_STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
 
 
 def predict_emotions(model, face_img):
@@ -8,17 +17,38 @@ def predict_emotions(model, face_img):
     return emotion, scores
 
 
+def predict_emotions_batch(model, face_imgs):
+    # same preprocessing as `HSEmotionRecognizer.predict_emotions`, but the crops are stacked
+    # and normalized together so the backbone runs once for the whole batch
+    size = model.img_size
+    batch = np.stack([
+        np.asarray(Image.fromarray(face_img).resize((size, size), Image.BILINEAR)) for face_img in face_imgs
+    ])
+    images = torch.from_numpy(batch).permute(0, 3, 1, 2).float().div_(255)
+    images = (images - _MEAN) / _STD
+
+    with torch.no_grad(), autocast():
+        features = model.model(images.to(model.device)).float().cpu().numpy()
+
+    scores = model.get_probab(features)
+    logits = scores[:, :-2] if model.is_mtl else scores
+    e_x = np.exp(logits - logits.max(axis=1, keepdims=True))
+    logits[:] = e_x / e_x.sum(axis=1, keepdims=True)
+    return scores
+
+
 def emotion_VA_MTL(device):
     model_name = 'enet_b0_8_va_mtl'
     fer = HSEmotionRecognizer(model_name=model_name, device=device)
     return fer
 
 
-_video_model = None
+def warmup_video_model(model):
+    predict_emotions_batch(model, [np.zeros((64, 64, 3), dtype=np.uint8)])
+
+
+registry.register("visual", lambda: emotion_VA_MTL(DEVICE), warmup_video_model)
 
 
 def get_video_model():
-    global _video_model
-    if _video_model is None:
-        _video_model = emotion_VA_MTL(DEVICE)
-    return _video_model
+    return registry.get("visual")
@@ -0,0 +1,144 @@
+import asyncio
+import os
+from pathlib import Path
+from typing import Optional
+
+from starlette.websockets import WebSocket
+
+from gen_audio_result import process_audio_file
+from gen_text_result import process_text_file
+from gen_visual_result import process_video_file
+from model.text2speech import text2speech
+from util.audio import AudioTrack
+from util.columnar import columnar_path
+from util.consts import SEGMENT_DURATION, SEGMENT_STRIDE
+from util.metrics import Timings, metrics
+from util.profiles import get_profile
+from util.progress import OrderedProgress, ProgressChannel, Sender, socket_sender
+from util.workers import get_inference_executor
+
+# order in which the status messages of the heads reach the client
+STAGES = ("audio", "text", "visual")
+
+
+def run_audio(video_path: str, audio_result_path: str, audio: AudioTrack, progress: ProgressChannel,
+    timings: Timings, segment_duration: float, segment_stride: float
+):
+    with timings.active(), timings.stage("audio"):
+        process_audio_file(video_path, audio_result_path, progress, audio.get(), segment_duration, segment_stride)
+    progress.done()
+
+
+def run_text(video_path: str, text2speech_path: str, text_result_path: str, lang: str, audio: AudioTrack,
+    progress: ProgressChannel, timings: Timings
+):
+    # the text head is the only one depending on another stage, so ASR runs on the same worker before it
+    with timings.active():
+        with timings.stage("asr"):
+            text2speech(video_path, text2speech_path, lang, audio.get())
+        with timings.stage("text"):
+            process_text_file(text2speech_path, text_result_path, lang, progress)
+    progress.done()
+
+
+def run_visual(video_path: str, visual_result_path: str, progress: ProgressChannel, frame_stride: int,
+    analysis_fps: Optional[float], track: bool, timings: Timings
+):
+    with timings.active(), timings.stage("visual"):
+        process_video_file(video_path, visual_result_path, progress, frame_stride, analysis_fps, track)
+    progress.done()
+
+
+async def run_pipeline(video_path: str, lang: str, send: Sender, frame_stride: int = 1,
+    analysis_fps: Optional[float] = None, track: bool = False, segment_duration: float = SEGMENT_DURATION,
+    segment_stride: float = SEGMENT_STRIDE
+):
+    video_dir = Path(video_path).parent
+    text2speech_path = str(video_dir / "text2speech.json")
+    audio_result_path = str(video_dir / "audio.csv")
+    text_result_path = str(video_dir / "text.csv")
+    visual_result_path = str(video_dir / "faces.csv")
+    timings_path = str(video_dir / "timings.json")
+
+    loop = asyncio.get_running_loop()
+    progress = OrderedProgress(STAGES, loop)
+    forwarding = asyncio.create_task(progress.forward(send))
+
+    # audio, ASR + text and visual run on their own worker, the wall-clock time is the slowest of them.
+    # The workers report through `progress`, which hands the messages over to the event loop thread-safely.
+    executor = get_inference_executor()
+    # the audio track is decoded once for the audio head and ASR
+    audio = AudioTrack(video_path)
+    # time spent in each head and span, saved next to the results
+    timings = Timings()
+    futures = [
+        loop.run_in_executor(executor, run_audio, video_path, audio_result_path, audio, progress.channel("audio"),
+            timings, segment_duration, segment_stride),
+        loop.run_in_executor(executor, run_text, video_path, text2speech_path, text_result_path, lang, audio,
+            progress.channel("text"), timings),
+        loop.run_in_executor(executor, run_visual, video_path, visual_result_path, progress.channel("visual"),
+            frame_stride, analysis_fps, track, timings),
+    ]
+    state = "failed"
+    try:
+        # every head is waited for before an error is raised, the threads cannot be stopped and would otherwise keep
+        # writing into the directory of a retried job
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if len(errors) > 0:
+            raise errors[0]
+        state = "done"
+    finally:
+        progress.close()
+        await forwarding
+        timings.finish()
+        timings.save(timings_path)
+        metrics.observe_job(timings, state)
+
+    return {
+        "id": video_dir.name,
+        "audio": audio_result_path.replace("\\", "/"),
+        "visual": visual_result_path.replace("\\", "/"),
+        "text": text_result_path.replace("\\", "/"),
+        "timings": timings_path.replace("\\", "/"),
+        # the profile the heads ran with
+        "profile": get_profile(),
+    }
+
+
+async def refine_audio(video_path: str, send: Sender, segment_duration: float = SEGMENT_DURATION,
+    segment_stride: float = SEGMENT_STRIDE
+):
+    # Runs the audio head again with other windows, e.g. the default ones after a preview. The new results are
+    # written aside and replace `audio.csv` once complete, so the previous ones stay readable meanwhile.
+    video_dir = Path(video_path).parent
+    audio_result_path = str(video_dir / "audio.csv")
+    refined_path = str(video_dir / "audio.refine.csv")
+
+    loop = asyncio.get_running_loop()
+    progress = OrderedProgress(("audio",), loop)
+    forwarding = asyncio.create_task(progress.forward(send))
+    try:
+        await loop.run_in_executor(get_inference_executor(), run_audio, video_path, refined_path,
+            AudioTrack(video_path), progress.channel("audio"), Timings(), segment_duration, segment_stride)
+    except BaseException:
+        for path in (refined_path, columnar_path(refined_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        progress.close()
+        await forwarding
+
+    for path, target in ((refined_path, audio_result_path),
+        (columnar_path(refined_path), columnar_path(audio_result_path))):
+        if os.path.exists(path):
+            os.replace(path, target)
+
+
+async def process_uploaded(video_path: str, lang: str, socket: WebSocket, frame_stride: int = 1,
+    analysis_fps: Optional[float] = None, track: bool = False, segment_duration: float = SEGMENT_DURATION,
+    segment_stride: float = SEGMENT_STRIDE
+):
+    return await run_pipeline(video_path, lang, socket_sender(socket), frame_stride, analysis_fps, track,
+        segment_duration, segment_stride)
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import shutil
+import warnings
+from pathlib import Path
+from typing import Tuple
+
+from fastapi import FastAPI, UploadFile, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from fastapi.staticfiles import StaticFiles
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.websockets import WebSocket
+
+from cache import result_cache
+from jobs import job_manager, parse_job_params, parse_audio_params, DONE, JOB_FILE
+from model.registry import registry
+from model.text2speech import shutdown_asr_executor
+from uploads import copy_and_hash, parse_upload_size, stream_to_file, upload_sessions, UploadTooLarge
+from util.columnar import COLUMNAR_MEDIA_TYPE, columnar_path
+from util.consts import DATA_DIR
+from util.metrics import metrics
+from util.misc import VideoNamePool, range_requests_response, prepare_checkpoints
+from util.profiles import get_profile, model_versions
+from util.progress import socket_sender, ACK_PROTOCOL, PUSH_PROTOCOL
+
+warnings.filterwarnings("ignore")
+
+app = FastAPI()
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+VideoNamePool.init()
+prepare_checkpoints()
+
+# files of an upload served by /api/data
+SERVED_EXTENSIONS = ("mp4", "csv", "bin", "json")
+
+
+@app.on_event("startup")
+async def start_jobs():
+    result_cache.load()
+    job_manager.start()
+
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    await job_manager.stop()
+    shutdown_asr_executor()
+
+
+@app.get("/api/data/{video_id}/{file_name}")
+async def get_file(video_id: str, file_name: str, request: Request):
+    # only the video and the results in the directory of an upload, not the job state or the cache index
+    data_dir = Path(DATA_DIR).resolve()
+    path = (data_dir / video_id / file_name).resolve()
+    extension = file_name.split(".")[-1]
+    if path.parent.parent != data_dir or path.name == JOB_FILE or extension not in SERVED_EXTENSIONS \
+        or not path.is_file():
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="File not found")
+    result_cache.touch(path.parent.name)
+
+    if extension == "mp4":
+        return range_requests_response(request, file_path=str(path), content_type="video/mp4")
+    elif extension == "bin":
+        return range_requests_response(request, file_path=str(path), content_type=COLUMNAR_MEDIA_TYPE)
+    elif extension == "csv":
+        # clients accepting the packed columnar format get it instead of the CSV of the same result
+        packed_path = columnar_path(str(path))
+        if COLUMNAR_MEDIA_TYPE in request.headers.get("accept", "") and os.path.isfile(packed_path):
+            response = range_requests_response(request, file_path=packed_path, content_type=COLUMNAR_MEDIA_TYPE)
+        else:
+            response = range_requests_response(request, file_path=str(path), content_type="text")
+        response.headers["vary"] = "Accept"
+        return response
+    else:
+        return range_requests_response(request, file_path=str(path), content_type="text")
+
+
+async def register_upload(file_id: int, content_hash: str) -> int:
+    existing = result_cache.find_video(content_hash)
+    if existing is not None:
+        # the same video was uploaded before, its id is returned so the analyses already done are reused
+        await run_in_threadpool(shutil.rmtree, Path(DATA_DIR) / str(file_id), True)
+        file_id = int(existing)
+    else:
+        result_cache.add_video(content_hash, str(file_id))
+    result_cache.touch(str(file_id))
+    result_cache.save()
+    await job_manager.evict({str(file_id)})
+    return file_id
+
+
+def new_video_path() -> Tuple[int, str]:
+    file_id = VideoNamePool.get()
+    path = Path(DATA_DIR) / str(file_id)
+    path.mkdir(exist_ok=True, parents=True)
+    return file_id, str(path / "video.mp4")
+
+
+def upload_too_large(file_id: int, e: UploadTooLarge) -> HTTPException:
+    shutil.rmtree(Path(DATA_DIR) / str(file_id), ignore_errors=True)
+    return HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+
+
+@app.post("/api/upload")
+async def upload_video(file: UploadFile):
+    file_id, video_path = new_video_path()
+    with open(video_path, "wb") as f:
+        try:
+            content_hash = await run_in_threadpool(copy_and_hash, file.file, f)
+        except UploadTooLarge as e:
+            raise upload_too_large(file_id, e)
+    return {"file_id": await register_upload(file_id, content_hash)}
+
+
+# the video is the raw request body, written to disk as it arrives instead of being parsed as a multipart form
+@app.post("/api/upload/stream")
+async def upload_video_stream(request: Request):
+    file_id, video_path = new_video_path()
+    sha = hashlib.sha256()
+    with open(video_path, "wb") as f:
+        try:
+            await stream_to_file(request.stream(), f, sha)
+        except UploadTooLarge as e:
+            raise upload_too_large(file_id, e)
+    return {"file_id": await register_upload(file_id, sha.hexdigest())}
+
+
+@app.post("/api/upload/sessions")
+async def create_upload_session(request: Request):
+    try:
+        payload = await request.json() if int(request.headers.get("content-length", 0)) > 0 else {}
+        size = parse_upload_size(payload)
+    except (AttributeError, TypeError, ValueError) as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        session = upload_sessions.create(size)
+    except UploadTooLarge as e:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    return session.to_dict()
+
+
+def get_upload_session(upload_id: str):
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Upload {upload_id} not found")
+    return session
+
+
+@app.get("/api/upload/sessions/{upload_id}")
+async def get_upload_offset(upload_id: str):
+    return get_upload_session(upload_id).to_dict()
+
+
+@app.put("/api/upload/sessions/{upload_id}")
+async def append_upload(upload_id: str, offset: int, request: Request):
+    session = get_upload_session(upload_id)
+    try:
+        await upload_sessions.append(session, offset, request.stream())
+    except UploadTooLarge as e:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except ValueError as e:
+        # the client resumes from the offset of the session
+        raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
+    return session.to_dict()
+
+
+@app.post("/api/upload/sessions/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    session = get_upload_session(upload_id)
+    file_id, video_path = new_video_path()
+    try:
+        content_hash = await upload_sessions.complete(session, video_path)
+    except ValueError as e:
+        shutil.rmtree(Path(DATA_DIR) / str(file_id), ignore_errors=True)
+        raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
+    return {"file_id": await register_upload(file_id, content_hash)}
+
+
+@app.delete("/api/upload/sessions/{upload_id}")
+async def discard_upload(upload_id: str):
+    upload_sessions.discard(get_upload_session(upload_id))
+    return {"upload_id": upload_id}
+
+
+@app.get("/api/models")
+async def get_models():
+    # the versions the results are computed with and the state of the loaded models
+    return {"profile": get_profile()["name"], "versions": model_versions(), "models": registry.stats()}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# a sync endpoint, so FastAPI runs the ffmpeg probe in its threadpool instead of on the event loop
+@app.get("/api/fps/{video_id}")
+def get_fps(video_id: str):
+    video_path = Path(DATA_DIR) / video_id / "video.mp4"
+    with VideoFileClip(str(video_path)) as video:
+        fps = video.fps
+        return {"fps": fps}
+
+
+@app.post("/api/jobs")
+async def submit_job(request: Request):
+    payload = await request.json()
+    try:
+        job = job_manager.submit(payload["file_id"], parse_job_params(payload))
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"job_id": job.id, "state": job.state}
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+    return job.status()
+
+
+@app.post("/api/jobs/{job_id}/refine")
+async def refine_job(job_id: str, request: Request):
+    # reruns the audio head of a finished job with finer windows, the body takes the audio options of `/ws/`
+    body = await request.body()
+    try:
+        audio_params = parse_audio_params(json.loads(body) if len(body) > 0 else {})
+    except (AttributeError, TypeError, ValueError) as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+    try:
+        job_manager.refine(job, audio_params)
+    except ValueError as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
+    return job.status()
+
+
+@app.websocket("/ws/")
+async def socket_connection(socket: WebSocket):
+    # the socket only follows the job, the analysis keeps going if the client disconnects
+    await socket.accept()
+    try:
+        video_info = await socket.receive_json()
+        # clients sending no protocol version use the acknowledged protocol. Checked before the job is queued, an
+        # invalid request must not start an analysis.
+        protocol = int(video_info.get("protocol", ACK_PROTOCOL))
+        if protocol not in (ACK_PROTOCOL, PUSH_PROTOCOL):
+            raise ValueError(f"Unknown protocol {protocol}")
+        params = parse_job_params(video_info)
+        job = job_manager.submit(video_info["file_id"], params)
+        send = socket_sender(socket, protocol)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        # invalid options or unknown video, reported with the failure status of the protocol
+        await socket.send_json({"status": "failed", "data": {"error": repr(e)}})
+        await socket.close()
+        return
+
+    await send({"status": "uploaded", "data": {}})
+    async for message in job.subscribe():
+        await send(message)
+
+    if job.state == DONE:
+        await socket.send_json({"status": "done", "data": job.result})
+    else:
+        await socket.send_json({"status": "failed", "data": {"error": job.error}})
+    await socket.close()
+
+
+app.mount("/", StaticFiles(directory=Path(__file__).parent.parent / "dist", html=True))
@@ -0,0 +1,351 @@
+# Benchmark of the heads and of the full pipeline on synthetic fixtures, run from `service/`:
+#
+#   PYTHONPATH=. python test/benchmark.py --output report.json
+#   PYTHONPATH=. python test/benchmark.py --baseline report.json
+#
+# The fixtures (a video with moving face-like shapes over a tone/noise track, and a canned transcript) are generated
+# in the work directory, so no data is downloaded. The models have to be in the local caches already.
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+STAGES = ("text2speech", "audio", "text", "visual", "pipeline")
+
+TRANSCRIPTS = {
+    "en": [
+        "I can't believe we finally made it here.",
+        "Honestly, this is the worst day I've had in a long time.",
+        "Could you tell me what happened after the meeting?",
+        "That sounds wonderful, thank you so much for coming.",
+        "I'm not sure, let me think about it for a moment.",
+        "Why would anyone do something like that?",
+    ],
+    "zh": [
+        "我真不敢相信我们终于到了。",
+        "说实话，这是我很久以来最糟糕的一天。",
+        "你能告诉我会议之后发生了什么吗？",
+        "听起来太好了，非常感谢你的到来。",
+        "我不确定，让我想一想。",
+        "怎么会有人做出那样的事情？",
+    ],
+}
+
+
+# fixtures
+
+def face_sprite(size: int, seed: int) -> np.ndarray:
+    # skin-coloured oval with eyes, brows, nose and mouth, on a transparent background
+    rng = np.random.default_rng(seed)
+    skin = tuple(int(c) for c in rng.integers([170, 120, 90], [235, 180, 150]))
+    image = Image.new("RGBA", (size, int(size * 1.25)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    w, h = image.size
+    draw.ellipse((0, 0, w - 1, h - 1), fill=skin + (255,))
+    for x in (0.3, 0.7):
+        draw.ellipse((w * (x - 0.09), h * 0.36, w * (x + 0.09), h * 0.44), fill=(250, 250, 250, 255))
+        draw.ellipse((w * (x - 0.04), h * 0.37, w * (x + 0.04), h * 0.43), fill=(40, 30, 20, 255))
+        draw.line((w * (x - 0.12), h * 0.3, w * (x + 0.12), h * 0.29), fill=(60, 40, 30, 255), width=max(1, w // 30))
+    draw.polygon([(w * 0.5, h * 0.45), (w * 0.44, h * 0.62), (w * 0.56, h * 0.62)], fill=tuple(c - 30 for c in skin))
+    draw.chord((w * 0.32, h * 0.66, w * 0.68, h * 0.82), 0, 180, fill=(150, 50, 50, 255))
+    return np.asarray(image)
+
+
+def render_frames(n_frames: int, width: int, height: int, n_faces: int = 2):
+    # faces drifting on a noisy gradient, with a slight change of size so the tracker has something to follow
+    rng = np.random.default_rng(0)
+    background = np.linspace(40, 120, width, dtype=np.float32)[None, :, None].repeat(height, 0).repeat(3, 2)
+    sprites = [face_sprite(height // 3, seed) for seed in range(n_faces)]
+    for i in range(n_frames):
+        frame = background + rng.normal(0, 4, background.shape).astype(np.float32)
+        for k, sprite in enumerate(sprites):
+            t = i / 50 + k * math.pi
+            scale = 1 + 0.1 * math.sin(t / 2)
+            sprite_h, sprite_w = int(sprite.shape[0] * scale), int(sprite.shape[1] * scale)
+            resized = np.asarray(Image.fromarray(sprite).resize((sprite_w, sprite_h)), dtype=np.float32)
+            x = int((width - sprite_w) * (0.5 + 0.35 * math.sin(t + k)))
+            y = int((height - sprite_h) * (0.5 + 0.3 * math.cos(t * 0.7)))
+            alpha = resized[..., 3:] / 255
+            region = frame[y:y + sprite_h, x:x + sprite_w]
+            region[:] = region * (1 - alpha) + resized[..., :3] * alpha
+        yield np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def synth_audio(duration: float, sample_rate: int) -> np.ndarray:
+    # voiced bursts (harmonic tone with a moving pitch) separated by pauses, over background noise
+    rng = np.random.default_rng(0)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    pitch = 140 + 40 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voice = sum(np.sin(h * phase) / h for h in range(1, 6))
+    envelope = ((t % 4.0) < 3.0) * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2)
+    audio = 0.2 * voice * envelope + rng.normal(0, 0.005, len(t))
+    return np.clip(audio, -1, 1).astype(np.float32)
+
+
+def write_wav(path: str, audio: np.ndarray, sample_rate: int):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((audio * 32767).astype("<i2").tobytes())
+
+
+def make_video(path: str, duration: float, fps: float, width: int, height: int, sample_rate: int):
+    wav_path = str(Path(path).with_suffix(".wav"))
+    write_wav(wav_path, synth_audio(duration, sample_rate), sample_rate)
+    cmd = [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+        "-i", wav_path, "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac",
+        "-shortest", path,
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    for frame in render_frames(int(duration * fps), width, height):
+        process.stdin.write(frame.tobytes())
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("Failed to encode the benchmark video")
+    os.remove(wav_path)
+
+
+def make_transcript(path: str, duration: float, lang: str, segment_duration: float = 3.0):
+    sentences = TRANSCRIPTS[lang]
+    segments = []
+    for k in range(int(duration / segment_duration)):
+        text = " " + sentences[k % len(sentences)]
+        segments.append({"id": k, "start": k * segment_duration, "end": (k + 1) * segment_duration, "text": text})
+    with open(path, "w", encoding="UTF-8") as f:
+        json.dump({"text": "".join(s["text"] for s in segments), "segments": segments, "language": lang}, f,
+            ensure_ascii=False, indent=4)
+    return len(segments)
+
+
+# measurement
+
+class RecordingProgress:
+    # stands in for the `ProgressChannel` of a head, the time of each progress message gives the step latencies
+
+    def __init__(self):
+        self.times: List[float] = []
+
+    def send(self, status: str, data: Optional[dict] = None):
+        self.times.append(time.perf_counter())
+
+    def done(self, data: Optional[dict] = None):
+        pass
+
+
+class RssSampler:
+    # peak resident memory of this process while a stage runs, the ASR worker processes are not included
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        from util.misc import get_rss
+        while not self._stop.is_set():
+            self.peak = max(self.peak, get_rss() or 0)
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    if len(values) == 0:
+        return None
+    values = np.asarray(values)
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+def measure(run: Callable[[RecordingProgress], None], items: int, unit: str, repeat: int, warmup: int) -> dict:
+    # the warmup runs load the models and are not measured
+    for _ in range(warmup):
+        run(RecordingProgress())
+
+    latencies = []
+    steps = []
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            progress = RecordingProgress()
+            start = time.perf_counter()
+            run(progress)
+            end = time.perf_counter()
+            latencies.append(end - start)
+            steps.extend(np.diff([start, *progress.times]).tolist())
+
+    latency = percentiles(latencies)
+    return {
+        "items": items,
+        "unit": unit,
+        "throughput": items / latency["p50"],
+        "latency_s": latency,
+        "step_latency_s": percentiles(steps),
+        "peak_rss_bytes": rss.peak,
+    }
+
+
+def run_benchmark(args) -> dict:
+    from gen_audio_result import process_audio_file
+    from gen_text_result import process_text_file
+    from gen_visual_result import process_video_file
+    from model.text2speech import text2speech
+    from pipeline import run_pipeline
+    from util.audio import load_audio
+    from util.consts import DEVICE, SEGMENT_STRIDE, REQUIRED_SAMPLE_RATE
+    from util.profiles import set_profile
+    from util.video import FrameReader
+
+    import torch
+
+    profile = set_profile(args.profile)
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="emolysis-benchmark-"))
+    work_dir.mkdir(exist_ok=True, parents=True)
+    video_path = str(work_dir / "video.mp4")
+    transcript_path = str(work_dir / "transcript.json")
+
+    print(f"[Benchmark] Generate fixtures in {work_dir}")
+    make_video(video_path, args.duration, args.fps, args.width, args.height, REQUIRED_SAMPLE_RATE)
+    n_segments = make_transcript(transcript_path, args.duration, args.lang)
+    n_frames = FrameReader(video_path).total
+    n_windows = math.ceil(args.duration / SEGMENT_STRIDE)
+
+    async def ignore(message: dict):
+        pass
+
+    runs = {
+        "text2speech": (
+            lambda progress: text2speech(video_path, str(work_dir / "text2speech.json"), args.lang,
+                load_audio(video_path)),
+            args.duration, "audio seconds"),
+        "audio": (
+            lambda progress: process_audio_file(video_path, str(work_dir / "audio.csv"), progress),
+            n_windows, "windows"),
+        "text": (
+            lambda progress: process_text_file(transcript_path, str(work_dir / "text.csv"), args.lang, progress),
+            n_segments, "segments"),
+        "visual": (
+            lambda progress: process_video_file(video_path, str(work_dir / "faces.csv"), progress,
+                args.frame_stride, None, args.track),
+            n_frames, "frames"),
+        "pipeline": (
+            lambda progress: asyncio.run(run_pipeline(video_path, args.lang, ignore, args.frame_stride, None,
+                args.track)),
+            args.duration, "video seconds"),
+    }
+
+    stages = {}
+    for name in args.stages:
+        print(f"[Benchmark] Run {name}")
+        run, items, unit = runs[name]
+        stages[name] = measure(run, items, unit, args.repeat, args.warmup)
+        print(f"[Benchmark] {name}: {stages[name]['throughput']:.2f} {unit}/s, "
+            f"p50 {stages[name]['latency_s']['p50']:.2f}s")
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "device": str(DEVICE),
+            "profile": profile,
+            "fixture": {
+                "duration": args.duration, "fps": args.fps, "width": args.width, "height": args.height,
+                "lang": args.lang, "frame_stride": args.frame_stride, "track": args.track,
+            },
+            "repeat": args.repeat,
+        },
+        "stages": stages,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    # a stage regresses when its throughput drops, or its peak memory grows, by more than `tolerance`
+    regressions = []
+    print(f"{'stage':<12} {'throughput':>12} {'baseline':>12} {'change':>8} {'peak RSS MB':>12} {'baseline':>10}")
+    for name, stage in report["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        change = stage["throughput"] / base["throughput"] - 1
+        print(f"{name:<12} {stage['throughput']:>12.2f} {base['throughput']:>12.2f} {change:>+8.1%} "
+            f"{stage['peak_rss_bytes'] / 1024 ** 2:>12.0f} {base['peak_rss_bytes'] / 1024 ** 2:>10.0f}")
+        if change < -tolerance:
+            regressions.append(f"{name} throughput {change:+.1%}")
+        if base["peak_rss_bytes"] > 0 and stage["peak_rss_bytes"] > base["peak_rss_bytes"] * (1 + tolerance):
+            regressions.append(f"{name} peak RSS {stage['peak_rss_bytes'] / base['peak_rss_bytes'] - 1:+.1%}")
+    return regressions
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--stages", type=str, nargs="+", choices=STAGES, default=list(STAGES))
+parser.add_argument("--profile", type=str, default=os.environ.get("EMOLYSIS_PROFILE", "balanced"))
+parser.add_argument("--lang", type=str, choices=list(TRANSCRIPTS), default="en")
+parser.add_argument("--duration", type=float, default=60.0, help="length of the generated video in seconds")
+parser.add_argument("--fps", type=float, default=25.0)
+parser.add_argument("--width", type=int, default=640)
+parser.add_argument("--height", type=int, default=360)
+parser.add_argument("--frame_stride", type=int, default=1)
+parser.add_argument("--track", action="store_true")
+parser.add_argument("--repeat", type=int, default=3, help="measured runs of each stage")
+parser.add_argument("--warmup", type=int, default=1, help="unmeasured runs of each stage before the measured ones")
+parser.add_argument("--work_dir", type=str, default=None, help="directory of the fixtures and results")
+parser.add_argument("--output", type=str, default=None, help="path of the JSON report")
+parser.add_argument("--baseline", type=str, default=None, help="JSON report to compare with")
+parser.add_argument("--tolerance", type=float, default=0.1, help="relative change counted as a regression")
+parser.add_argument("--gpu", action="store_true", help="run on the GPU when there is one, CPU only by default")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # before torch is imported
+    if not args.gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    # the models are read from the local caches only
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+    report = run_benchmark(args)
+    if args.output is not None:
+        with open(args.output, "w", encoding="UTF-8") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="UTF-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            print(f"[Benchmark] Regressions: {', '.join(regressions)}")
+            sys.exit(1)
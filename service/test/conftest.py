@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# the service modules are imported from the service directory, as when the server runs
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# scripts running the full models, not unit tests
+collect_ignore = ["integration_test.py", "benchmark.py"]
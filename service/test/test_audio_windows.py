@@ -0,0 +1,115 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# gen_audio_result imports the audio head
+gen_audio_result = pytest.importorskip("gen_audio_result")
+
+from util.consts import REQUIRED_SAMPLE_RATE
+from util.label_space_mapping import bold_to_main_batch, bold_to_main_va
+
+
+def brute_force_bins(starts, ends):
+    # every interval between two window boundaries, with the windows covering it
+    edges = sorted(set(starts) | set(ends))
+    bins = []
+    for bin_start, bin_end in zip(edges[:-1], edges[1:]):
+        covering = [k for k, (start, end) in enumerate(zip(starts, ends)) if start <= bin_start and end >= bin_end]
+        if len(covering) > 0:
+            bins.append((bin_start, bin_end, covering[0], covering[-1]))
+    return bins
+
+
+@pytest.mark.parametrize("duration, segment_duration, segment_stride", [
+    (100.0, 15.0, 7.5),
+    (98.3, 15.0, 7.5),
+    (100.0, 30.0, 30.0),
+    (95.5, 30.0, 30.0),
+    # non-integer ratios, the bins are not all the same length
+    (50.0, 10.0, 4.0),
+    (47.3, 10.0, 3.0),
+    (33.0, 5.0, 2.5),
+    # shorter than a window
+    (4.2, 15.0, 7.5),
+])
+def test_overlap_bins(duration, segment_duration, segment_stride):
+    starts, ends = gen_audio_result.audio_windows(duration, segment_duration, segment_stride)
+    assert ends[-1] == int(duration * 1000)
+    bin_starts, bin_ends, first, last = gen_audio_result.overlap_bins(starts, ends)
+
+    assert list(zip(bin_starts, bin_ends, first, last)) == brute_force_bins(starts.tolist(), ends.tolist())
+    # the bins tile the track and `last` is non-decreasing, the rows can be written as the windows complete
+    assert bin_starts[0] == 0 and bin_ends[-1] == ends[-1]
+    assert (bin_starts[1:] == bin_ends[:-1]).all()
+    assert (np.diff(last) >= 0).all()
+
+
+def window_outputs(n_windows, seed=0):
+    # BOLD space outputs of the audio head for each window: valence, arousal, 26 emotions
+    rng = np.random.default_rng(seed)
+    return rng.uniform(1, 10, n_windows), rng.uniform(1, 10, n_windows), rng.uniform(0, 1, (n_windows, 26))
+
+
+def baseline_rows(duration, segment_duration, segment_stride, outputs):
+    # the aggregation of the first version of the audio head, windows split in two halves at start + stride
+    valence, arousal, emotion = outputs
+    data = OrderedDict()
+    for n, i in enumerate(np.arange(0.0, duration, segment_stride)):
+        start_time = int(i * 1000) / 1000
+        end_time = int(min(i + segment_duration, duration) * 1000) / 1000
+        result = np.array([bold_to_main_va(arousal[n]), bold_to_main_va(valence[n]),
+            *bold_to_main_batch(emotion[n:n + 1])[0]])
+        mid_time = start_time + segment_stride
+        keys = [(start_time, mid_time), (mid_time, end_time)] if mid_time < duration else [(start_time, end_time)]
+        for key in keys:
+            data.setdefault(key, []).append(result)
+
+    rows = []
+    for (start, end), values in data.items():
+        value = np.stack(values).mean(axis=0)
+        value[2:] = value[2:] / value[2:].sum()
+        rows.append([start, end, value[1], value[0], *value[2:]])
+    return pd.DataFrame(rows, columns=["start", "end", "valence", "arousal"] + [f"emotion{k}" for k in range(9)])
+
+
+class NullProgress:
+
+    def send(self, status, data):
+        pass
+
+
+@pytest.mark.parametrize("duration, segment_duration, segment_stride", [
+    (100.0, 15.0, 7.5),
+    (98.3, 15.0, 7.5),
+    (100.0, 30.0, 30.0),
+    (95.5, 30.0, 30.0),
+])
+# the rows are written as the batches complete
+@pytest.mark.parametrize("batch_size", [3, 64])
+def test_aggregation_matches_baseline(tmp_path, monkeypatch, duration, segment_duration, segment_stride, batch_size):
+    starts, _ = gen_audio_result.audio_windows(duration, segment_duration, segment_stride)
+    outputs = window_outputs(len(starts))
+    start_index = {start: k for k, start in enumerate(starts.tolist())}
+    samples_per_ms = REQUIRED_SAMPLE_RATE // 1000
+
+    def fake_features(audios):
+        # the track is a ramp of the sample index, so each window is found back from its first sample
+        indices = [start_index[int(round(audio[0])) // samples_per_ms] for audio in audios]
+        valence, arousal, emotion = outputs
+        return valence[indices], arousal[indices], emotion[indices], None
+
+    monkeypatch.setattr(gen_audio_result, "get_emotion_features_from_audios", fake_features)
+    monkeypatch.setattr(gen_audio_result, "get_profile", lambda: {"audio_batch_size": batch_size})
+    audio = np.arange(int(duration * REQUIRED_SAMPLE_RATE), dtype=np.float64)
+    result_path = str(tmp_path / "audio.csv")
+    gen_audio_result.process_audio_file("video.mp4", result_path, NullProgress(), audio, segment_duration,
+        segment_stride)
+
+    result = pd.read_csv(result_path)
+    expected = baseline_rows(duration, segment_duration, segment_stride, outputs)
+    # with a stride equal to the windows the first version also wrote an empty half at the end of each window
+    expected = expected[expected["end"] > expected["start"]].reset_index(drop=True)
+    assert len(result) == len(expected)
+    np.testing.assert_allclose(result.to_numpy(), expected.to_numpy(), atol=1e-9)
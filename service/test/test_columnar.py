@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+from util.columnar import ResultWriter, columnar_path, read_columnar, write_columnar
+
+
+def test_round_trip_keeps_confidences_and_timestamps(tmp_path):
+    df = pd.DataFrame({
+        "frame": np.arange(4),
+        "x1": [0, 100, 40000, -5],
+        "start": [0.0, 0.123456, 0.5, 0.987654],
+        "box_prob": [0.998765, 0.912345, 0.954321, 0.999999],
+        "valence": [-12.5, 3.25, 100.0, 0.0],
+        "emotion0": [0.1, 0.2, 0.3, 0.4],
+        "emotion8": [0.9, 0.8, 0.7, 0.6],
+    })
+    path = str(tmp_path / "faces.bin")
+    write_columnar(df, path)
+    loaded = read_columnar(path)
+
+    assert list(loaded.columns) == list(df.columns)
+    assert loaded["frame"].dtype == np.int16
+    assert loaded["x1"].dtype == np.int32
+    np.testing.assert_array_equal(loaded["x1"], df["x1"])
+    for name in ("start", "box_prob", "valence"):
+        assert loaded[name].dtype == np.float32
+        np.testing.assert_allclose(loaded[name], df[name], rtol=1e-6)
+    for name in ("emotion0", "emotion8"):
+        assert loaded[name].dtype == np.float16
+        np.testing.assert_allclose(loaded[name], df[name], atol=1e-3)
+
+
+def test_round_trip_without_rows(tmp_path):
+    path = str(tmp_path / "audio.bin")
+    write_columnar(pd.DataFrame({"start": np.zeros(0), "emotion0": np.zeros(0)}), path)
+    loaded = read_columnar(path)
+    assert len(loaded) == 0 and list(loaded.columns) == ["start", "emotion0"]
+
+
+def test_result_writer_packs_the_spilled_chunks(tmp_path):
+    result_path = str(tmp_path / "faces.csv")
+    rows = [{"frame": k, "x1": k * 2000, "box_prob": 0.5 + k / 100, "emotion0": k / 20} for k in range(20)]
+    with ResultWriter(result_path, chunk_rows=3) as writer:
+        for k in range(0, len(rows), 2):
+            writer.write(rows[k:k + 2])
+
+    packed = read_columnar(columnar_path(result_path))
+    expected = pd.read_csv(result_path)
+    assert list(packed.columns) == list(expected.columns)
+    assert packed["frame"].dtype == np.int16 and packed["x1"].dtype == np.int32
+    for name in expected.columns:
+        np.testing.assert_allclose(packed[name], expected[name], atol=1e-3)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["faces.bin", "faces.csv"]
+
+
+def test_result_writer_without_rows(tmp_path):
+    result_path = str(tmp_path / "text.csv")
+    with ResultWriter(result_path):
+        pass
+    assert len(read_columnar(columnar_path(result_path))) == 0
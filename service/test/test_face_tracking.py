@@ -0,0 +1,52 @@
+import numpy as np
+
+from util.face_tracking import FaceRowInterpolator, FaceTracker, interpolate_face_rows
+
+
+def face_row(frame, x1=10, face_id=0):
+    return {"frame": frame, "face_id": face_id, "x1": x1, "y1": 10, "x2": x1 + 20, "y2": 30, "box_prob": 0.99,
+        "valence": 0, "arousal": 0}
+
+
+def frames_of(rows):
+    return [row["frame"] for row in rows]
+
+
+def test_faces_are_interpolated_between_keyframes():
+    rows = interpolate_face_rows([face_row(0, x1=10), face_row(4, x1=50)], frames=[0, 4], last_frame=7, max_gap=3)
+    assert frames_of(rows) == list(range(8))
+    assert [row["x1"] for row in rows] == [10, 20, 30, 40, 50, 50, 50, 50]
+
+
+def test_empty_keyframe_ends_the_faces():
+    # analysed every 5 frames, a face at frame 0 and frame 1000 only
+    frames = range(0, 1001, 5)
+    rows = interpolate_face_rows([face_row(0), face_row(1000)], frames, last_frame=1004, max_gap=4)
+    assert frames_of(rows) == [0, 1, 2, 3, 4, 1000, 1001, 1002, 1003, 1004]
+
+
+def test_gap_between_keyframes_is_bounded():
+    # keyframes further apart than the stride, e.g. frames without a decoded image, are not bridged
+    rows = interpolate_face_rows([face_row(0), face_row(1000)], [0, 1000], last_frame=1004, max_gap=4)
+    assert frames_of(rows) == [0, 1, 2, 3, 4, 1000, 1001, 1002, 1003, 1004]
+
+
+def test_incremental_feed_matches_whole_rows():
+    rows = [face_row(0), face_row(3, x1=40), face_row(9, x1=70)]
+    frames = [0, 3, 6, 9]
+    interpolator = FaceRowInterpolator(max_gap=2)
+    dense = interpolator.feed([0, 3], rows[:2]) + interpolator.feed([6, 9], rows[2:]) + interpolator.close(11)
+    assert dense == interpolate_face_rows(rows, frames, last_frame=11, max_gap=2)
+    assert frames_of(dense) == [0, 1, 2, 3, 4, 5, 9, 10, 11]
+
+
+def test_tracker_builds_templates_only_when_tracking():
+    frame = np.random.default_rng(0).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    boxes, probs = [[20, 20, 60, 70], [90, 30, 130, 80]], [0.99, 0.98]
+    for track in (False, True):
+        tracker = FaceTracker(track=track)
+        faces = tracker.update(frame, boxes, probs)
+        # the ids are kept across detections either way
+        faces = tracker.update(frame, [[22, 20, 62, 70]] + boxes[1:], probs)
+        assert [face.face_id for face in faces] == [0, 1]
+        assert all((face.template is not None) == track for face in faces)
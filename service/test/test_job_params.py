@@ -0,0 +1,57 @@
+import pytest
+
+# jobs imports the pipeline, and so the heads
+jobs = pytest.importorskip("jobs")
+
+
+@pytest.mark.parametrize("payload, expected", [
+    ({}, (15.0, 7.5)),
+    ({"audio_preset": "default"}, (15.0, 7.5)),
+    ({"audio_preset": "preview"}, (30.0, 30.0)),
+    ({"audio_preset": "preview", "segment_stride": 10}, (30.0, 10.0)),
+    ({"segment_duration": 10, "segment_stride": 4}, (10.0, 4.0)),
+    ({"segment_duration": "20", "segment_stride": "20"}, (20.0, 20.0)),
+    ({"segment_duration": 2, "segment_stride": 1}, (2.0, 1.0)),
+    ({"segment_duration": 60, "segment_stride": 60}, (60.0, 60.0)),
+])
+def test_audio_params(payload, expected):
+    params = jobs.parse_audio_params(payload)
+    assert (params["segment_duration"], params["segment_stride"]) == expected
+
+
+@pytest.mark.parametrize("payload, message", [
+    ({"audio_preset": "fine"}, "Unknown audio_preset"),
+    ({"segment_duration": 1.5}, "segment_duration"),
+    ({"segment_duration": 61}, "segment_duration"),
+    ({"segment_stride": 0.5}, "segment_stride"),
+    # longer than the default windows of 15 s, the audio would not be covered
+    ({"segment_stride": 16}, "segment_stride"),
+    ({"audio_preset": "preview", "segment_duration": 10}, "segment_stride"),
+    ({"segment_duration": "long"}, "could not convert"),
+])
+def test_invalid_audio_params(payload, message):
+    with pytest.raises(ValueError, match=message):
+        jobs.parse_audio_params(payload)
+
+
+@pytest.mark.parametrize("payload, expected", [
+    ({"lang": "en"}, {"lang": "en", "frame_stride": 1, "analysis_fps": None, "track": False,
+        "segment_duration": 15.0, "segment_stride": 7.5}),
+    ({"lang": "zh", "frame_stride": "3", "analysis_fps": 5, "track": 1, "audio_preset": "preview"},
+        {"lang": "zh", "frame_stride": 3, "analysis_fps": 5.0, "track": True, "segment_duration": 30.0,
+            "segment_stride": 30.0}),
+])
+def test_job_params(payload, expected):
+    assert jobs.parse_job_params(payload) == expected
+
+
+@pytest.mark.parametrize("payload", [
+    {},
+    {"lang": "fr"},
+    {"lang": "en", "frame_stride": 0},
+    {"lang": "en", "analysis_fps": 0},
+    {"lang": "en", "audio_preset": "fine"},
+])
+def test_invalid_job_params(payload):
+    with pytest.raises(ValueError):
+        jobs.parse_job_params(payload)
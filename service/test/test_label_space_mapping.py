@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from util.label_space_mapping import affectnet_to_main_batch, affectnet_to_main_va, affectnet_to_main_valence, \
+    bold_to_main_batch, bold_to_main_va, bold_to_main_arousal, cped_to_main_batch
+
+
+def test_batch_matches_the_per_emotion_sums():
+    scores = np.random.default_rng(0).random((4, 10))
+    expected = np.stack([[s[1] + s[3], s[0], s[4], s[6], s[2], s[7], 0., 0., s[5]] for s in scores])
+    np.testing.assert_allclose(affectnet_to_main_batch(scores), expected)
+    np.testing.assert_allclose(affectnet_to_main_batch(scores[0]), expected[0])
+
+
+@pytest.mark.parametrize("to_main, n_source, main_index", [
+    # the first source emotion is anger in AffectNet, peace in BOLD and happy in CPED
+    (affectnet_to_main_batch, 8, 1),
+    (bold_to_main_batch, 26, 2),
+    (cped_to_main_batch, 13, 2),
+])
+def test_nan_score_only_reaches_its_main_emotion(to_main, n_source, main_index):
+    scores = np.random.default_rng(1).random((3, n_source))
+    expected = to_main(scores)
+    scores[1, 0] = np.nan
+    expected[1, main_index] = np.nan
+    np.testing.assert_allclose(to_main(scores), expected)
+
+
+def test_nan_valence_and_arousal_pass_through():
+    values = np.array([0.5, np.nan, -1.0])
+    np.testing.assert_allclose(affectnet_to_main_va(values), [affectnet_to_main_valence(v) for v in values])
+    assert np.isnan(bold_to_main_va([np.nan]))[0] and np.isnan(bold_to_main_arousal(np.nan))
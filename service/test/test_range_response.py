@@ -0,0 +1,114 @@
+import re
+
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from starlette.testclient import TestClient
+
+from util.misc import FileRangeResponse, _get_ranges
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(CONTENT)
+    app = FastAPI()
+
+    @app.get("/file")
+    async def get_file(request: Request):
+        # small reads, so the ranges are sent in several messages
+        return FileRangeResponse(request, file_path=str(path), content_type="video/mp4", chunk_size=100)
+
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("header, size, expected", [
+    ("bytes=0-99", 1000, [(0, 99)]),
+    ("bytes=900-", 1000, [(900, 999)]),
+    ("bytes=-100", 1000, [(900, 999)]),
+    ("bytes=-2000", 1000, [(0, 999)]),
+    ("bytes=990-2000", 1000, [(990, 999)]),
+    ("bytes=0-9, 20-29", 1000, [(0, 9), (20, 29)]),
+    # sorted, overlapping and adjacent ranges merged
+    ("bytes=20-29,0-9,5-14,15-16", 1000, [(0, 16), (20, 29)]),
+    # unsatisfiable parts are skipped when another one is satisfiable
+    ("bytes=2000-3000,0-0", 1000, [(0, 0)]),
+])
+def test_get_ranges(header, size, expected):
+    assert _get_ranges(header, size) == expected
+
+
+@pytest.mark.parametrize("header", ["items=0-9", "bytes=", "bytes=a-b", "bytes=10", "bytes=50-40", "bytes=1000-"])
+def test_get_ranges_invalid(header):
+    with pytest.raises(HTTPException) as e:
+        _get_ranges(header, 1000)
+    assert e.value.status_code == 416
+    assert e.value.headers["content-range"] == "bytes */1000"
+
+
+def test_full_file(client):
+    response = client.get("/file")
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["content-length"] == str(len(CONTENT))
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_single_range(client):
+    response = client.get("/file", headers={"range": "bytes=100-1199"})
+    assert response.status_code == 206
+    assert response.content == CONTENT[100:1200]
+    assert response.headers["content-length"] == "1100"
+    assert response.headers["content-range"] == f"bytes 100-1199/{len(CONTENT)}"
+
+
+def test_multiple_ranges(client):
+    response = client.get("/file", headers={"range": "bytes=0-9,500-509,-5"})
+    assert response.status_code == 206
+    boundary = re.fullmatch(r"multipart/byteranges; boundary=(\w+)", response.headers["content-type"]).group(1)
+    assert int(response.headers["content-length"]) == len(response.content)
+
+    parts = response.content.split(f"--{boundary}".encode())
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    bodies = []
+    for part in parts[1:-1]:
+        head, body = part.split(b"\r\n\r\n", 1)
+        assert b"content-type: video/mp4" in head
+        bodies.append((head, body[:-2] if body.endswith(b"\r\n") else body))
+    assert [body for _, body in bodies] == [CONTENT[0:10], CONTENT[500:510], CONTENT[-5:]]
+    assert f"content-range: bytes 500-509/{len(CONTENT)}".encode() in bodies[1][0]
+
+
+def test_unsatisfiable_range(client):
+    response = client.get("/file", headers={"range": f"bytes={len(CONTENT)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+
+def test_not_modified(client):
+    headers = client.get("/file").headers
+    for conditional in ({"if-none-match": headers["etag"]}, {"if-none-match": f'"other", W/{headers["etag"]}'},
+        {"if-modified-since": headers["last-modified"]}):
+        response = client.get("/file", headers=conditional)
+        assert response.status_code == 304
+        assert response.content == b""
+
+    response = client.get("/file", headers={"if-none-match": '"other"'})
+    assert response.status_code == 200
+    # If-None-Match takes precedence over If-Modified-Since
+    response = client.get("/file", headers={"if-none-match": '"other"', "if-modified-since": headers["last-modified"]})
+    assert response.status_code == 200
+
+
+def test_if_range(client):
+    headers = client.get("/file").headers
+    ranged = {"range": "bytes=0-9"}
+    assert client.get("/file", headers={**ranged, "if-range": headers["etag"]}).status_code == 206
+    assert client.get("/file", headers={**ranged, "if-range": headers["last-modified"]}).status_code == 206
+    # another version of the file, or a weak validator, gets the whole file
+    for if_range in ('"other"', f'W/{headers["etag"]}', "Thu, 01 Jan 1970 00:00:00 GMT"):
+        response = client.get("/file", headers={**ranged, "if-range": if_range})
+        assert response.status_code == 200
+        assert response.content == CONTENT
+
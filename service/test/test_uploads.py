@@ -0,0 +1,28 @@
+import pytest
+
+from uploads import parse_upload_size
+
+
+@pytest.mark.parametrize("payload, expected", [
+    ({"size": 1}, 1),
+    ({"size": "2048"}, 2048),
+])
+def test_upload_size(payload, expected):
+    assert parse_upload_size(payload) == expected
+
+
+@pytest.mark.parametrize("payload, message", [
+    ({}, "size is required"),
+    ({"size": None}, "size is required"),
+    ({"size": 0}, "positive"),
+    ({"size": -5}, "positive"),
+    ({"size": "big"}, "invalid literal"),
+])
+def test_invalid_upload_size(payload, message):
+    with pytest.raises(ValueError, match=message):
+        parse_upload_size(payload)
+
+
+def test_upload_size_of_a_list():
+    with pytest.raises(TypeError):
+        parse_upload_size({"size": [1]})
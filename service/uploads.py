@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Dict, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from util.consts import MAX_UPLOAD_SIZE, UPLOAD_DIR, UPLOAD_CHUNK_SIZE
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def parse_upload_size(payload: dict) -> int:
+    # size in bytes announced by the client when it creates a resumable upload
+    size = payload.get("size")
+    if size is None:
+        raise ValueError("size is required")
+    size = int(size)
+    if size <= 0:
+        raise ValueError("size should be a positive integer")
+    return size
+
+
+def copy_and_hash(src: BinaryIO, dst: BinaryIO, max_size: int = MAX_UPLOAD_SIZE) -> str:
+    # the upload is hashed while it is written, so the file is read only once
+    sha = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = src.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise UploadTooLarge(f"Upload larger than {max_size} bytes")
+        sha.update(chunk)
+        dst.write(chunk)
+    return sha.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+async def stream_to_file(stream: AsyncIterator[bytes], f: BinaryIO, sha: Optional["hashlib._Hash"], size: int = 0,
+    max_size: int = MAX_UPLOAD_SIZE
+) -> int:
+    # Copies a request body to `f` in chunks of at most `UPLOAD_CHUNK_SIZE`, so the memory used does not depend on
+    # the size of the upload. The disk writes run in the threadpool. Returns the size of the file after the copy.
+    buffer = bytearray()
+    async for chunk in stream:
+        size += len(chunk)
+        if size > max_size:
+            raise UploadTooLarge(f"Upload larger than {max_size} bytes")
+        if sha is not None:
+            sha.update(chunk)
+        buffer += chunk
+        if len(buffer) >= UPLOAD_CHUNK_SIZE:
+            await run_in_threadpool(f.write, bytes(buffer))
+            buffer.clear()
+    if len(buffer) > 0:
+        await run_in_threadpool(f.write, bytes(buffer))
+    return size
+
+
+class UploadSession:
+
+    def __init__(self, upload_id: str, size: int = 0, expected_size: Optional[int] = None):
+        self.id = upload_id
+        self.size = size
+        self.expected_size = expected_size
+        # None for a session resumed after a restart, the file is hashed again when it is completed
+        self.sha = hashlib.sha256() if size == 0 else None
+        self.lock = asyncio.Lock()
+
+    @property
+    def path(self) -> Path:
+        return Path(UPLOAD_DIR) / f"{self.id}.part"
+
+    def to_dict(self) -> dict:
+        return {"upload_id": self.id, "offset": self.size, "size": self.expected_size}
+
+
+class UploadSessions:
+    # Resumable uploads: the client creates a session, appends the chunks at the offset returned by the server, and
+    # asks for the current offset to resume after a broken connection. The partial file is kept in `UPLOAD_DIR`,
+    # so a session also survives a server restart.
+
+    def __init__(self):
+        self.sessions: Dict[str, UploadSession] = {}
+
+    def create(self, expected_size: Optional[int] = None) -> UploadSession:
+        if expected_size is not None and expected_size > MAX_UPLOAD_SIZE:
+            raise UploadTooLarge(f"Upload larger than {MAX_UPLOAD_SIZE} bytes")
+        session = UploadSession(uuid.uuid4().hex, expected_size=expected_size)
+        session.path.parent.mkdir(exist_ok=True, parents=True)
+        session.path.touch()
+        self.sessions[session.id] = session
+        return session
+
+    def get(self, upload_id: str) -> Optional[UploadSession]:
+        if not _UPLOAD_ID.match(upload_id):
+            return None
+        session = self.sessions.get(upload_id)
+        if session is None:
+            path = Path(UPLOAD_DIR) / f"{upload_id}.part"
+            if path.exists():
+                session = UploadSession(upload_id, size=path.stat().st_size)
+                self.sessions[upload_id] = session
+        return session
+
+    async def append(self, session: UploadSession, offset: int, stream: AsyncIterator[bytes]):
+        async with session.lock:
+            if offset != session.size:
+                raise ValueError(f"Upload {session.id} is at offset {session.size}, not {offset}")
+            max_size = session.expected_size if session.expected_size is not None else MAX_UPLOAD_SIZE
+            with open(session.path, "ab") as f:
+                try:
+                    session.size = await stream_to_file(stream, f, session.sha, session.size, max_size)
+                except BaseException:
+                    # a chunk is kept whole or not at all, so the client can resend it from the same offset
+                    f.truncate(session.size)
+                    session.sha = None
+                    raise
+
+    async def complete(self, session: UploadSession, video_path: str) -> str:
+        # moves the uploaded file to `video_path` and returns its hash
+        async with session.lock:
+            if session.expected_size is not None and session.size != session.expected_size:
+                raise ValueError(f"Upload {session.id} has {session.size} of {session.expected_size} bytes")
+            content_hash = session.sha.hexdigest() if session.sha is not None \
+                else await run_in_threadpool(hash_file, str(session.path))
+            Path(video_path).parent.mkdir(exist_ok=True, parents=True)
+            await run_in_threadpool(shutil.move, str(session.path), video_path)
+            del self.sessions[session.id]
+            return content_hash
+
+    def discard(self, session: UploadSession):
+        self.sessions.pop(session.id, None)
+        if session.path.exists():
+            os.remove(session.path)
+
+
+upload_sessions = UploadSessions()
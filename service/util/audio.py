@@ -0,0 +1,95 @@
+import subprocess
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from util.consts import REQUIRED_SAMPLE_RATE, ASR_CHUNK_DURATION, VAD_FRAME_DURATION, VAD_THRESHOLD_DB, \
+    VAD_MIN_ENERGY_DB, VAD_MIN_SILENCE, VAD_PADDING
+from util.metrics import span
+
+
+def load_audio(file_path: str, sample_rate: int = REQUIRED_SAMPLE_RATE) -> np.ndarray:
+    # decode, downmix and resample the whole audio track in one ffmpeg pass, as mono float32 in [-1, 1]
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", file_path,
+        "-vn", "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "-",
+    ]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode(errors='ignore')}") from e
+
+    return np.frombuffer(out, np.float32)
+
+
+class AudioTrack:
+    # The 16 kHz waveform of a video, decoded by the first head asking for it and shared with the other ones
+
+    def __init__(self, file_path: str, sample_rate: int = REQUIRED_SAMPLE_RATE):
+        self.file_path = file_path
+        self.sample_rate = sample_rate
+        self._audio: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> np.ndarray:
+        with self._lock:
+            if self._audio is None:
+                with span("audio.decode"):
+                    self._audio = load_audio(self.file_path, self.sample_rate)
+            return self._audio
+
+
+def _frame_energy(audio: np.ndarray, frame_length: int) -> np.ndarray:
+    # RMS of each frame in dBFS
+    n_frames = len(audio) // frame_length
+    frames = audio[:n_frames * frame_length].reshape(n_frames, frame_length)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def split_on_voice(audio: np.ndarray, sample_rate: int = REQUIRED_SAMPLE_RATE,
+    max_duration: float = ASR_CHUNK_DURATION
+) -> List[Tuple[int, int]]:
+    # Energy based voice activity detection. Returns the (start, end) sample ranges of the voiced parts, packed
+    # into chunks of at most `max_duration` seconds, so the chunks can be transcribed independently. A voiced part
+    # longer than that is cut at its quietest frame.
+    frame_length = int(VAD_FRAME_DURATION * sample_rate)
+    energy = _frame_energy(audio, frame_length)
+    if len(energy) == 0:
+        return []
+
+    # relative to the noise floor of the track, so the level of the recording does not matter
+    threshold = max(np.percentile(energy, 10) + VAD_THRESHOLD_DB, VAD_MIN_ENERGY_DB)
+    voiced = energy > threshold
+
+    # voiced frames closer than `VAD_MIN_SILENCE` are one part, each part is padded on both sides
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], voiced.astype(np.int8), [0]])))
+    max_gap = int(VAD_MIN_SILENCE / VAD_FRAME_DURATION)
+    padding = int(VAD_PADDING / VAD_FRAME_DURATION)
+    parts = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        if len(parts) > 0 and start - parts[-1][1] <= max_gap:
+            parts[-1][1] = end
+        else:
+            parts.append([start, end])
+    parts = [(max(0, start - padding), min(len(energy), end + padding)) for start, end in parts]
+
+    max_frames = int(max_duration / VAD_FRAME_DURATION)
+    chunks = []
+    for start, end in parts:
+        while end - start > max_frames:
+            # leave some room before the limit to find a pause
+            search_start = start + max_frames // 2
+            cut = search_start + int(np.argmin(energy[search_start:start + max_frames]))
+            chunks.append([start, cut])
+            start = cut
+        if len(chunks) > 0 and end - chunks[-1][0] <= max_frames:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+    # the samples after the last whole frame belong to the last chunk
+    return [
+        (start * frame_length, len(audio) if end == len(energy) else end * frame_length) for start, end in chunks
+    ]
@@ -0,0 +1,228 @@
+import json
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from util.consts import COLUMNAR_RESULTS, RESULT_CHUNK_ROWS
+from util.metrics import span
+
+# Packed columnar result file:
+#   magic (4 bytes) | header length (uint32 LE) | JSON header | column 0 | column 1 | ...
+# The header lists the row count and the name, dtype and byte offset of each column. Each column is a little-endian
+# array starting 8-byte aligned, so the client can view it as a typed array without parsing. Integer columns are
+# stored as int16 when they fit, the emotion probabilities as float16, the other values as float32/int32.
+COLUMNAR_MAGIC = b"EMOL"
+COLUMNAR_MEDIA_TYPE = "application/vnd.emolysis.columnar"
+COLUMNAR_SUFFIX = ".bin"
+
+_DTYPES = {"float32": "<f4", "float16": "<f2", "int32": "<i4", "int16": "<i2"}
+# float16 keeps about 3 significant digits, enough to draw the probabilities but not for the boxes confidences or
+# the timestamps
+_FLOAT16_COLUMNS = tuple(f"emotion{k}" for k in range(9))
+
+
+def columnar_path(result_path: str) -> str:
+    return str(Path(result_path).with_suffix(COLUMNAR_SUFFIX))
+
+
+def _float_dtype(name: str) -> str:
+    return "float16" if name in _FLOAT16_COLUMNS else "float32"
+
+
+def _column_dtype(name: str, values: np.ndarray) -> str:
+    if np.issubdtype(values.dtype, np.integer):
+        info = np.iinfo(np.int16)
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return "int16"
+        return "int32"
+    return _float_dtype(name)
+
+
+def _pad(length: int) -> int:
+    return -length % 8
+
+
+def _column_bytes(rows: int, dtype: str) -> int:
+    return rows * np.dtype(_DTYPES[dtype]).itemsize
+
+
+def _write_header(f: BinaryIO, rows: int, columns: List[Tuple[str, str]]):
+    # columns: (name, dtype) in the order their data follows the header
+
+    def build_header(data_start: int) -> bytes:
+        entries = []
+        offset = data_start
+        for name, dtype in columns:
+            entries.append({"name": name, "dtype": dtype, "offset": offset})
+            nbytes = _column_bytes(rows, dtype)
+            offset += nbytes + _pad(nbytes)
+        return json.dumps({"version": 1, "rows": rows, "columns": entries}).encode()
+
+    # the offsets are written in the header, so its length is found first with a placeholder start
+    prefix_length = len(COLUMNAR_MAGIC) + 4
+    header = build_header(0)
+    while True:
+        data_start = prefix_length + len(header) + _pad(prefix_length + len(header))
+        new_header = build_header(data_start)
+        if len(new_header) == len(header):
+            break
+        header = new_header
+    header = new_header + b" " * (data_start - prefix_length - len(new_header))
+
+    f.write(COLUMNAR_MAGIC)
+    f.write(struct.pack("<I", len(header)))
+    f.write(header)
+
+
+def write_columnar(df: pd.DataFrame, path: str):
+    arrays = []
+    for name in df.columns:
+        values = df[name].to_numpy()
+        dtype = _column_dtype(str(name), values)
+        arrays.append((str(name), dtype, np.ascontiguousarray(values, dtype=_DTYPES[dtype])))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        _write_header(f, len(df), [(name, dtype) for name, dtype, _ in arrays])
+        for _, _, array in arrays:
+            f.write(array.tobytes())
+            f.write(b"\0" * _pad(array.nbytes))
+    os.replace(tmp_path, path)
+
+
+def read_columnar(path: str) -> pd.DataFrame:
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        raise ValueError(f"{path} is not a columnar result file")
+
+    header_length, = struct.unpack_from("<I", data, len(COLUMNAR_MAGIC))
+    offset = len(COLUMNAR_MAGIC) + 4
+    header = json.loads(data[offset:offset + header_length])
+
+    return pd.DataFrame({
+        column["name"]: np.frombuffer(data, dtype=_DTYPES[column["dtype"]], count=header["rows"],
+            offset=column["offset"])
+        for column in header["columns"]
+    })
+
+
+class ResultWriter:
+    # Appends the result rows of a head to its CSV in flushed chunks of `chunk_rows`, so the partial results can be
+    # read while the head is running and only one chunk is kept in memory. The chunks are also appended column by
+    # column to a spill file, which is rearranged into the packed columnar file one column chunk at a time when the
+    # writer is closed.
+
+    def __init__(self, result_path: str, chunk_rows: int = RESULT_CHUNK_ROWS):
+        self.result_path = result_path
+        self.chunk_rows = chunk_rows
+        self.columns: Optional[List[str]] = None
+        self.buffer: List[Dict] = []
+        self.rows = 0
+        # (name, dtype) of the spilled columns, the integers are spilled as int32 and packed as int16 if they fit
+        self.spill_columns: Optional[List[Tuple[str, str]]] = None
+        # (file offset, rows) of the spilled chunks
+        self.spill_chunks: List[Tuple[int, int]] = []
+        self.int_ranges: Dict[str, Tuple[int, int]] = {}
+        self.spill: Optional[BinaryIO] = None
+
+        Path(result_path).parent.mkdir(exist_ok=True, parents=True)
+        # a packed file of an earlier run would not match the CSV being written
+        if os.path.exists(columnar_path(result_path)):
+            os.remove(columnar_path(result_path))
+        self.file = open(result_path, "w", encoding="UTF-8", newline="")
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            self._remove_spill()
+
+    def write(self, rows: Iterable[Dict]):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        with span("csv.write", items=len(self.buffer)):
+            df = pd.DataFrame(self.buffer, columns=self.columns)
+            if self.columns is None:
+                self.columns = list(df.columns)
+            df.to_csv(self.file, index=False, header=self.rows == 0)
+            self.file.flush()
+        if COLUMNAR_RESULTS:
+            self._spill_chunk(df)
+        self.rows += len(self.buffer)
+        self.buffer = []
+
+    def status(self) -> dict:
+        # rows and bytes written so far, sent with the progress messages
+        return {"rows": self.rows, "bytes": self.file.tell()}
+
+    def _spill_chunk(self, df: pd.DataFrame):
+        if self.spill is None:
+            self.spill_columns = [
+                (name, "int32" if np.issubdtype(df[name].dtype, np.integer) else _float_dtype(name))
+                for name in self.columns
+            ]
+            self.spill = open(columnar_path(self.result_path) + ".spill", "w+b")
+
+        self.spill_chunks.append((self.spill.tell(), len(df)))
+        for name, dtype in self.spill_columns:
+            values = np.ascontiguousarray(df[name].to_numpy(), dtype=_DTYPES[dtype])
+            if dtype == "int32" and len(values) > 0:
+                low, high = self.int_ranges.get(name, (values.min(), values.max()))
+                self.int_ranges[name] = (min(low, values.min()), max(high, values.max()))
+            self.spill.write(values.tobytes())
+
+    def _packed_dtype(self, name: str, dtype: str) -> str:
+        if dtype != "int32" or name not in self.int_ranges:
+            return dtype
+        low, high = self.int_ranges[name]
+        info = np.iinfo(np.int16)
+        return "int16" if low >= info.min and high <= info.max else "int32"
+
+    def _write_packed(self):
+        path = columnar_path(self.result_path)
+        columns = [(name, self._packed_dtype(name, dtype)) for name, dtype in self.spill_columns]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            _write_header(f, self.rows, columns)
+            for k, ((_, spill_dtype), (_, dtype)) in enumerate(zip(self.spill_columns, columns)):
+                for chunk_offset, chunk_rows in self.spill_chunks:
+                    # the columns of a chunk follow each other in the spill file
+                    self.spill.seek(chunk_offset + sum(_column_bytes(chunk_rows, d) for _, d in self.spill_columns[:k]))
+                    data = self.spill.read(_column_bytes(chunk_rows, spill_dtype))
+                    f.write(np.frombuffer(data, dtype=_DTYPES[spill_dtype]).astype(_DTYPES[dtype]).tobytes())
+                nbytes = _column_bytes(self.rows, dtype)
+                f.write(b"\0" * _pad(nbytes))
+        os.replace(tmp_path, path)
+
+    def _remove_spill(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.remove(self.spill.name)
+            self.spill = None
+
+    def close(self):
+        self.flush()
+        if self.rows == 0:
+            pd.DataFrame(columns=self.columns).to_csv(self.file, index=False)
+        self.file.close()
+        if COLUMNAR_RESULTS:
+            with span("columnar.write", items=max(self.rows, 1)):
+                if self.rows > 0:
+                    self._write_packed()
+                else:
+                    write_columnar(pd.DataFrame(columns=self.columns), columnar_path(self.result_path))
+            self._remove_spill()
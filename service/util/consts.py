@@ -6,6 +6,15 @@ DEVICE = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("
 SEGMENT_STRIDE = 7.5
 SEGMENT_DURATION = 15.0
 REQUIRED_SAMPLE_RATE = 16000
+# audio windows (duration, stride) in seconds a job can ask for with "audio_preset". "preview" is a coarse first
+# pass with a quarter of the TRILL/AudioDnn passes, it can be refined later with the default windows.
+AUDIO_PRESETS = {
+    "default": (SEGMENT_DURATION, SEGMENT_STRIDE),
+    "preview": (30.0, 30.0),
+}
+MIN_SEGMENT_DURATION = 2.0
+MAX_SEGMENT_DURATION = 60.0
+MIN_SEGMENT_STRIDE = 1.0
 
 LINGUISTIC_MODEL_EN_PATH = os.path.join("checkpoints", "linguistic_head_en.ckpt")
 LINGUISTIC_MODEL_ZH_PATH = os.path.join("checkpoints", "linguistic_head_zh.ckpt")
@@ -18,3 +27,105 @@ AUDIO_MODEL_URL = "https://github.com/ControlNet/emolysis/releases/download/misc
 COMMUNICATION_VISUAL_STEP = 100
 COMMUNICATION_AUDIO_STEP = 10
 COMMUNICATION_LINGUISTIC_STEP = 10
+
+DATA_DIR = "data"
+# partial files of the resumable uploads
+UPLOAD_DIR = "uploads"
+MAX_UPLOAD_SIZE = 8 * 1024 ** 3
+# uploads are copied to disk in chunks of this size, whatever the size of the video
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# also write the results as packed columnar files (faces.bin, ...), served to clients accepting them
+COLUMNAR_RESULTS = True
+# result rows appended to the output files at a time while a head is running
+RESULT_CHUNK_ROWS = 256
+# largest read per message when /api/data serves a file
+RANGE_CHUNK_SIZE = 1024 * 1024
+# the least recently used analyses are removed when the data directory grows over this size
+MAX_CACHE_SIZE = 20 * 1024 ** 3
+# part of the result cache key, bump when a head or its checkpoint changes so the cached results are not reused. The
+# fields are filled from the active profile.
+MODEL_VERSIONS = {
+    "audio": "trill-3/audio_model_trill",
+    "text": "whisper-{whisper_model}/linguistic_head/emotion-english-distilroberta-base",
+    "visual": "mtcnn/enet_b0_8_va_mtl",
+}
+
+# threads running the heads, shared by all the jobs of the server
+INFERENCE_WORKERS = 3
+# jobs analysed at the same time, the other ones wait in the queue
+JOB_WORKERS = 1
+
+# frames are decoded at most this many pixels on their longest side, the detector works at this resolution. None
+# decodes them at the resolution of the video.
+VIDEO_DECODE_MAX_SIDE = None
+# decoded frames queued ahead of the visual head
+FRAME_PREFETCH = 8
+# ffmpeg hardware decoder, e.g. "auto" or "cuda", None decodes on the CPU
+VIDEO_HWACCEL = None
+
+# "vad" transcribes the voiced chunks of the audio in parallel, "full" transcribes the whole track in one pass
+ASR_MODE = "vad"
+# processes transcribing the chunks when there is no GPU, the chunks are transcribed in turn on the GPU
+ASR_WORKERS = 2
+# longest chunk given to Whisper, its input window is 30 seconds
+ASR_CHUNK_DURATION = 30.0
+VAD_FRAME_DURATION = 0.03
+# frames louder than the noise floor by this many dB are voiced
+VAD_THRESHOLD_DB = 15.0
+VAD_MIN_ENERGY_DB = -60.0
+# pauses shorter than this do not split the speech
+VAD_MIN_SILENCE = 0.5
+VAD_PADDING = 0.2
+
+VISUAL_BATCH_SIZE = 32
+AUDIO_BATCH_SIZE = 32
+DETECTION_BATCH_SIZE = 16
+TEXT_BATCH_SIZE = 32
+# transcript segments given to the text head at a time, sorted by length into batches of `text_batch_size`
+TEXT_CHUNK_SEGMENTS = 256
+# longest input of the RoBERTa encoders
+TEXT_MAX_LENGTH = 512
+
+# Inference profiles, picked with `--profile` or the EMOLYSIS_PROFILE environment variable, "balanced" is the
+# default. "precision" is "fp32", "bf16" (autocast of the heads) or "int8" (dynamic quantization of the linear
+# layers, CPU only, bf16 on the GPUs supporting it and fp32 on the other ones). `decode_max_side` None detects the
+# faces at the resolution of the video.
+PROFILES = {
+    "fast": {
+        "whisper_model": "tiny",
+        "precision": "int8",
+        "decode_max_side": 640,
+        "visual_batch_size": 64,
+        "audio_batch_size": 64,
+        "detection_batch_size": 32,
+        "text_batch_size": 64,
+    },
+    "balanced": {
+        "whisper_model": "base",
+        "precision": "fp32",
+        "decode_max_side": VIDEO_DECODE_MAX_SIDE,
+        "visual_batch_size": VISUAL_BATCH_SIZE,
+        "audio_batch_size": AUDIO_BATCH_SIZE,
+        "detection_batch_size": DETECTION_BATCH_SIZE,
+        "text_batch_size": TEXT_BATCH_SIZE,
+    },
+    "accurate": {
+        "whisper_model": "small",
+        "precision": "fp32",
+        "decode_max_side": None,
+        "visual_batch_size": VISUAL_BATCH_SIZE,
+        "audio_batch_size": AUDIO_BATCH_SIZE,
+        "detection_batch_size": DETECTION_BATCH_SIZE,
+        "text_batch_size": TEXT_BATCH_SIZE,
+    },
+}
+DEFAULT_PROFILE = "balanced"
+
+# IoU needed to treat two boxes in neighbouring analysed frames as the same face
+TRACK_MIN_IOU = 0.3
+# tracking mode, number of analysed frames between two face detections
+DETECTION_KEYFRAME_INTERVAL = 10
+# normalized cross-correlation below which a tracked face is re-detected
+TRACK_MIN_CONFIDENCE = 0.7
+TRACK_MAX_MISSED = 2
+TRACK_TEMPLATE_SIZE = 32
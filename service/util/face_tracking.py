@@ -0,0 +1,228 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from util.consts import TRACK_MIN_IOU, TRACK_MIN_CONFIDENCE, TRACK_MAX_MISSED, DETECTION_KEYFRAME_INTERVAL, \
+    TRACK_TEMPLATE_SIZE
+
+_BOX_KEYS = ("x1", "y1", "x2", "y2")
+_INT_KEYS = _BOX_KEYS + ("valence", "arousal")
+# columns copied from the earlier keyframe instead of being interpolated
+_HOLD_KEYS = ("face_id",)
+
+
+def box_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    # boxes in (x1, y1, x2, y2) format, returns the [len(boxes_a), len(boxes_b)] IoU matrix
+    boxes_a = np.asarray(boxes_a, dtype=float).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=float).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.)
+
+
+def match_boxes(boxes_a: Sequence, boxes_b: Sequence, min_iou: float = TRACK_MIN_IOU) -> List[Tuple[int, int]]:
+    # greedy one-to-one matching, highest IoU first
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return []
+    iou = box_iou(np.asarray(boxes_a), np.asarray(boxes_b))
+    matched_a, matched_b = set(), set()
+    matches = []
+    for flat_index in np.argsort(-iou, axis=None):
+        a, b = np.unravel_index(flat_index, iou.shape)
+        if iou[a, b] < min_iou:
+            break
+        if a in matched_a or b in matched_b:
+            continue
+        matched_a.add(a)
+        matched_b.add(b)
+        matches.append((int(a), int(b)))
+    return matches
+
+
+def _row_box(row: Dict) -> List[float]:
+    return [row[key] for key in _BOX_KEYS]
+
+
+def _match_rows(rows_a: List[Dict], rows_b: List[Dict]) -> Dict[int, int]:
+    if len(rows_a) > 0 and "face_id" in rows_a[0]:
+        index_b = {row["face_id"]: b for b, row in enumerate(rows_b)}
+        return {a: index_b[row["face_id"]] for a, row in enumerate(rows_a) if row["face_id"] in index_b}
+    return dict(match_boxes([_row_box(r) for r in rows_a], [_row_box(r) for r in rows_b]))
+
+
+def _interpolate_row(row_a: Dict, row_b: Dict, frame: int, weight: float) -> Dict:
+    row = {"frame": frame}
+    for key, value in row_a.items():
+        if key == "frame":
+            continue
+        if key not in row_b or key in _HOLD_KEYS:
+            row[key] = value
+            continue
+        mixed = value + (row_b[key] - value) * weight
+        row[key] = int(round(mixed)) if key in _INT_KEYS else mixed
+    return row
+
+
+def interpolate_keyframes(frame_a: int, rows_a: List[Dict], frame_b: int, rows_b: List[Dict],
+    max_gap: Optional[int] = None
+) -> List[Dict]:
+    # rows of keyframe `frame_a` and of every frame before `frame_b`, at most `max_gap` of them. Faces matched across
+    # the two keyframes are linearly interpolated (box, emotion, valence and arousal), unmatched faces are held.
+    matches = _match_rows(rows_a, rows_b) if len(rows_b) > 0 else {}
+    dense = list(rows_a)
+    end = frame_b if max_gap is None else min(frame_b, frame_a + max_gap + 1)
+    for frame in range(frame_a + 1, end):
+        weight = (frame - frame_a) / (frame_b - frame_a)
+        for a, row_a in enumerate(rows_a):
+            if a in matches:
+                dense.append(_interpolate_row(row_a, rows_b[matches[a]], frame, weight))
+            else:
+                dense.append({**row_a, "frame": frame})
+    return dense
+
+
+class FaceRowInterpolator:
+    # Incremental `interpolate_face_rows`: the analysed keyframes are fed in frame order with their rows, and the
+    # dense rows up to a keyframe are returned as soon as the next keyframe is known. Every analysed frame is a
+    # keyframe, one without faces ends the faces of the previous one. At most `max_gap` frames are filled after a
+    # keyframe, the frames skipped by the stride.
+
+    def __init__(self, max_gap: int):
+        self.max_gap = max_gap
+        self.frame: Optional[int] = None
+        self.rows: List[Dict] = []
+
+    def feed(self, frames: Iterable[int], rows: Iterable[Dict]) -> List[Dict]:
+        # frames: the analysed frames, including the ones without faces, rows: the faces of these frames
+        by_frame = defaultdict(list)
+        for row in rows:
+            by_frame[row["frame"]].append(row)
+
+        dense = []
+        for frame in frames:
+            frame_rows = by_frame[frame]
+            if self.frame is not None:
+                dense.extend(interpolate_keyframes(self.frame, self.rows, frame, frame_rows, self.max_gap))
+            self.frame, self.rows = frame, frame_rows
+        return dense
+
+    def close(self, last_frame: int) -> List[Dict]:
+        # the faces of the last keyframe are held until `last_frame`
+        if self.frame is None:
+            return []
+        dense = interpolate_keyframes(self.frame, self.rows, last_frame + 1, [], self.max_gap)
+        self.frame, self.rows = None, []
+        return dense
+
+
+def interpolate_face_rows(rows: List[Dict], frames: Iterable[int], last_frame: int, max_gap: int) -> List[Dict]:
+    # rows only cover the analysed keyframes `frames`, fill the frames up to `last_frame` in between
+    interpolator = FaceRowInterpolator(max_gap)
+    return interpolator.feed(sorted(frames), rows) + interpolator.close(last_frame)
+
+
+def _face_template(frame: np.ndarray, box: np.ndarray) -> Optional[np.ndarray]:
+    # small zero-mean, unit-norm grayscale patch, compared by normalized cross-correlation
+    x1, y1, x2, y2 = box.astype(int)
+    crop = frame[max(0, y1):max(0, y2), max(0, x1):max(0, x2)]
+    if crop.size == 0:
+        return None
+    patch = Image.fromarray(crop).convert("L").resize((TRACK_TEMPLATE_SIZE, TRACK_TEMPLATE_SIZE), Image.BILINEAR)
+    patch = np.asarray(patch, dtype=np.float32).ravel()
+    patch = patch - patch.mean()
+    norm = np.linalg.norm(patch)
+    return patch / norm if norm > 0 else None
+
+
+class FaceTrack:
+
+    def __init__(self, face_id: int, box: np.ndarray, prob: float, template: Optional[np.ndarray]):
+        self.face_id = face_id
+        self.box = box
+        self.detected_box = box
+        self.prob = prob
+        self.template = template
+        self.velocity = np.zeros(4)
+        self.missed = 0
+
+
+class FaceTracker:
+    # `update` takes the detections of a frame and assigns stable face ids. `propagate` moves the faces with a
+    # constant velocity model and checks them against their appearance at the last detection, it returns None
+    # when a new detection is needed (keyframe interval reached or a track lost confidence). Without `track` only
+    # the face ids are assigned, the appearance templates `propagate` needs are not built.
+
+    def __init__(self, keyframe_interval: int = DETECTION_KEYFRAME_INTERVAL,
+        min_confidence: float = TRACK_MIN_CONFIDENCE, track: bool = True
+    ):
+        self.keyframe_interval = keyframe_interval
+        self.track = track
+        self.min_confidence = min_confidence
+        self.tracks: List[FaceTrack] = []
+        self.next_id = 0
+        # the first analysed frame is always detected
+        self.steps_since_detection = keyframe_interval
+
+    @property
+    def live_tracks(self) -> List[FaceTrack]:
+        return [track for track in self.tracks if track.missed == 0]
+
+    def update(self, frame: np.ndarray, bounding_boxes: Sequence, probs: Sequence) -> List[FaceTrack]:
+        boxes = [np.asarray(box[:4], dtype=float) for box in bounding_boxes]
+        matches = dict((b, a) for a, b in match_boxes([track.box for track in self.tracks], boxes))
+
+        tracks = []
+        matched_tracks = set()
+        steps = max(1, self.steps_since_detection)
+        for b, box in enumerate(boxes):
+            template = _face_template(frame, box) if self.track else None
+            if b in matches:
+                track = self.tracks[matches[b]]
+                matched_tracks.add(matches[b])
+                track.velocity = (box - track.detected_box) / steps if track.missed == 0 else np.zeros(4)
+                track.box = box
+                track.detected_box = box
+                track.prob = probs[b]
+                track.template = template
+                track.missed = 0
+            else:
+                track = FaceTrack(self.next_id, box, probs[b], template)
+                self.next_id += 1
+            tracks.append(track)
+
+        # keep unmatched tracks around for a few detections, so a face missed once gets its id back
+        for a, track in enumerate(self.tracks):
+            if a not in matched_tracks and track.missed < TRACK_MAX_MISSED:
+                track.missed += 1
+                tracks.append(track)
+
+        self.tracks = tracks
+        self.steps_since_detection = 0
+        return self.live_tracks
+
+    def propagate(self, frame: np.ndarray) -> Optional[List[FaceTrack]]:
+        self.steps_since_detection += 1
+        if self.steps_since_detection >= self.keyframe_interval:
+            return None
+
+        height, width = frame.shape[:2]
+        tracks = self.live_tracks
+        boxes = []
+        for track in tracks:
+            box = np.clip(track.box + track.velocity, 0, [width, height, width, height])
+            current = _face_template(frame, box)
+            if track.template is None or current is None or float(track.template @ current) < self.min_confidence:
+                return None
+            boxes.append(box)
+
+        for track, box in zip(tracks, boxes):
+            track.box = box
+        return tracks
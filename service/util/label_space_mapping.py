@@ -5,51 +5,89 @@ import numpy as np
 # =============================================================================
 
 
-def affectnet_to_main(emo_scores):
-    emo_prob = np.zeros(9)
-    emo_prob[0] = emo_scores[1] + emo_scores[3]  # fear (contempt + fear)
-    emo_prob[1] = emo_scores[0]  # anger (anger)
-    emo_prob[2] = emo_scores[4]  # joy (happy)
-    emo_prob[3] = emo_scores[6]  # sadness (sad)
-    emo_prob[4] = emo_scores[2]  # disgust (disgust)
-    emo_prob[5] = emo_scores[7]  # surprise
-    emo_prob[6] = 0.0  # trust
-    emo_prob[7] = 0.0  # anticipation
-    emo_prob[8] = emo_scores[5]  # none
+def projection_matrix(mapping, n_source):
+    # [n_source, 9] matrix summing the source emotions into the main ones, `mapping` lists the source indices of
+    # each main emotion
+    matrix = np.zeros((n_source, 9))
+    for main_index, source_indices in enumerate(mapping):
+        matrix[source_indices, main_index] = 1.0
+    return matrix
+
+
+AFFECTNET_TO_MAIN = projection_matrix([
+    [1, 3],  # fear (contempt + fear)
+    [0],  # anger (anger)
+    [4],  # joy (happy)
+    [6],  # sadness (sad)
+    [2],  # disgust (disgust)
+    [7],  # surprise
+    [],  # trust
+    [],  # anticipation
+    [5],  # none
+], 8)
+
+BOLD_TO_MAIN = projection_matrix([
+    [22, 23],  # fear (disquitement + fear)
+    [18, 19],  # anger (annoyance +anger)
+    [0, 1, 2, 4, 5, 6, 7, 10, 15],  # joy (peace+affection+engagement+confidence+happy+pleasure+sympathy+yearning)
+    [12, 13, 14, 20, 21, 24, 25],  # sadness
+    [16, 17],  # disgust
+    [8, 9, 11],  # surprise
+    [],  # trust
+    [3],  # anticipation
+    [],  # none
+], 26)
+
+CPED_TO_MAIN = projection_matrix([
+    [7, 11],  # fear
+    [5],  # anger
+    [0, 1, 2, 3],  # joy
+    [6, 8, 12],  # sadness
+    [9],  # disgust
+    [10],  # surprise
+    [],  # trust
+    [],  # anticipation
+    [4],  # none
+], 13)
+
+
+def project(emo_scores, matrix, normalize=False):
+    # maps [N, K] (or [K]) scores to [N, 9] (or [9]) in one product, extra trailing columns such as the
+    # valence/arousal outputs of the AffectNet model are ignored. `normalize` makes each row sum to 1.
+    emo_scores = np.asarray(emo_scores, dtype=np.float64)[..., :matrix.shape[0]]
+    if np.all(np.isfinite(emo_scores)):
+        emo_prob = emo_scores @ matrix
+    else:
+        # 0 * NaN is NaN, so the product would spread a NaN score to every main emotion. Summed under the mask of
+        # the matrix, it only reaches the ones it is part of, as in the per-emotion sums.
+        emo_prob = np.where(matrix > 0, emo_scores[..., :, None], 0.0).sum(axis=-2)
+    if normalize:
+        emo_prob /= emo_prob.sum(axis=-1, keepdims=True)
     return emo_prob
 
 
+def affectnet_to_main_batch(emo_scores, normalize=False):
+    return project(emo_scores, AFFECTNET_TO_MAIN, normalize)
+
+
+def bold_to_main_batch(emo_scores, normalize=False):
+    return project(emo_scores, BOLD_TO_MAIN, normalize)
+
+
+def cped_to_main_batch(emo_scores, normalize=False):
+    return project(emo_scores, CPED_TO_MAIN, normalize)
+
+
+def affectnet_to_main(emo_scores):
+    return affectnet_to_main_batch(emo_scores)
+
+
 def bold_to_main(emo_scores):
-    emo_prob = np.zeros(9)
-    emo_prob[0] = emo_scores[22] + emo_scores[23]  # fear (disquitement + fear)
-    emo_prob[1] = emo_scores[18] + emo_scores[19]  # anger (annoyance +anger)
-    emo_prob[2] = emo_scores[0] + emo_scores[1] + emo_scores[2] \
-                  + emo_scores[4] + emo_scores[5] + emo_scores[6] + emo_scores[7] \
-                  + emo_scores[10] + emo_scores[
-                      15]  # joy (peace+affection+engagement+confidence+happy+pleasure+sympathy+yearning)
-    emo_prob[3] = emo_scores[12] + emo_scores[13] + emo_scores[14] + emo_scores[20] \
-                  + emo_scores[21] + emo_scores[24] + emo_scores[25]  # sadness
-    emo_prob[4] = emo_scores[16] + emo_scores[17]  # disgust
-    emo_prob[5] = emo_scores[8] + emo_scores[9] + emo_scores[11]  # surprise
-    emo_prob[6] = 0.0  # trust
-    emo_prob[7] = emo_scores[3]  # anticipation
-    emo_prob[8] = 0.0  # none
-    return emo_prob
+    return bold_to_main_batch(emo_scores)
 
 
 def cped_to_main(emo_scores):
-    emo_prob = np.zeros(9)
-    emo_prob[0] = emo_scores[7] + emo_scores[11]  # fear
-    emo_prob[1] = emo_scores[5]  # anger
-    emo_prob[2] = emo_scores[0] + emo_scores[1] + emo_scores[2] \
-                  + emo_scores[3]  # joy
-    emo_prob[3] = emo_scores[6] + emo_scores[8] + emo_scores[12]  # sadness
-    emo_prob[4] = emo_scores[9]  # disgust
-    emo_prob[5] = emo_scores[10]  # surprise
-    emo_prob[6] = 0.0  # trust
-    emo_prob[7] = 0.0  # anticipation
-    emo_prob[8] = emo_scores[4]  # none
-    return emo_prob
+    return cped_to_main_batch(emo_scores)
 
 
 # =============================================================================
@@ -68,6 +106,27 @@ def translate(value, r1_Min, r1_Max, r2_Min, r2_Max):
     return r2_Min + (valueScaled * r2_Span)
 
 
+AFFECTNET_RANGE = (-1, 1)
+BOLD_RANGE = (1, 10)
+MAIN_RANGE = (1, 1000)
+
+
+def rescale(values, source_range, target_range=MAIN_RANGE):
+    # vectorized `translate` of an array of valence or arousal scores, NaN scores stay NaN as they do with it
+    values = np.asarray(values, dtype=np.float64)
+    return target_range[0] + (values - source_range[0]) / (source_range[1] - source_range[0]) \
+        * (target_range[1] - target_range[0])
+
+
+def affectnet_to_main_va(values):
+    # valence and arousal use the same range, so this maps both
+    return rescale(values, AFFECTNET_RANGE)
+
+
+def bold_to_main_va(values):
+    return rescale(values, BOLD_RANGE)
+
+
 def affectnet_to_main_valence(valence_score):
     try:
         affectnet_min = -1
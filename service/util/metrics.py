@@ -0,0 +1,198 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# upper bounds in seconds, of the time per item of a span and of the time per job
+ITEM_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+JOB_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 1800.0, 3600.0)
+
+
+def _labels(*labels: str) -> str:
+    labels = [label for label in labels if label]
+    return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+
+class Histogram:
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float, count: int = 1):
+        # `count` observations of `value`, a batch of items is recorded with the mean time per item
+        for k, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[k] += count
+                break
+        self.count += count
+        self.sum += value * count
+
+    def render(self, name: str, labels: str = "") -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{name}_bucket{_labels(labels, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{name}_bucket{_labels(labels, le)} {self.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {self.count}")
+        return lines
+
+
+class Metrics:
+    # Process-wide histograms, rendered in the Prometheus text format by `/metrics`:
+    #   emolysis_span_seconds{span}      time per item of each instrumented span (frame, face, window, message, row)
+    #   emolysis_job_span_seconds{span}  total time of each span per job
+    #   emolysis_stage_seconds{stage}    wall time of each head per job
+    #   emolysis_job_seconds             wall time of the jobs
+    #   emolysis_jobs_total{state}       finished jobs
+
+    def __init__(self):
+        self.spans: Dict[str, Histogram] = {}
+        self.job_spans: Dict[str, Histogram] = {}
+        self.stages: Dict[str, Histogram] = {}
+        self.jobs = Histogram(JOB_BUCKETS)
+        self.job_states: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _histogram(histograms: Dict[str, Histogram], name: str, buckets: Sequence[float]) -> Histogram:
+        if name not in histograms:
+            histograms[name] = Histogram(buckets)
+        return histograms[name]
+
+    def observe_span(self, name: str, seconds: float, items: int):
+        with self._lock:
+            self._histogram(self.spans, name, ITEM_BUCKETS).observe(seconds / max(items, 1), max(items, 1))
+
+    def observe_job(self, timings: "Timings", state: str):
+        with self._lock:
+            for name, span_total in timings.spans.items():
+                self._histogram(self.job_spans, name, JOB_BUCKETS).observe(span_total["seconds"])
+            for name, seconds in timings.stages.items():
+                self._histogram(self.stages, name, JOB_BUCKETS).observe(seconds)
+            self.jobs.observe(timings.elapsed())
+            self.job_states[state] = self.job_states.get(state, 0) + 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, label, histograms, description in (
+                ("emolysis_span_seconds", "span", self.spans, "Time per item of the instrumented spans"),
+                ("emolysis_job_span_seconds", "span", self.job_spans, "Total time of the spans per job"),
+                ("emolysis_stage_seconds", "stage", self.stages, "Wall time of the heads per job"),
+            ):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(histograms.items()):
+                    lines.extend(histogram.render(name, f'{label}="{key}"'))
+
+            lines.append("# HELP emolysis_job_seconds Wall time of the jobs")
+            lines.append("# TYPE emolysis_job_seconds histogram")
+            lines.extend(self.jobs.render("emolysis_job_seconds"))
+
+            lines.append("# HELP emolysis_jobs_total Finished jobs")
+            lines.append("# TYPE emolysis_jobs_total counter")
+            for state, count in sorted(self.job_states.items()):
+                lines.append(f'emolysis_jobs_total{{state="{state}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Timings:
+    # Totals of the spans and wall time of the heads of one job, written as `timings.json` next to its results.
+    # The heads of a job run in several worker threads and add to the same totals.
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.spans: Dict[str, Dict[str, float]] = {}
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, items: int):
+        with self._lock:
+            span_total = self.spans.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0})
+            span_total["seconds"] += seconds
+            span_total["calls"] += 1
+            span_total["items"] += items
+
+    def elapsed(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    @contextmanager
+    def active(self):
+        # spans of the current thread are added to this job until the block ends
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages[name] = time.perf_counter() - start
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = {
+                name: {**span_total, "per_item": span_total["seconds"] / max(span_total["items"], 1)}
+                for name, span_total in sorted(self.spans.items())
+            }
+            return {"total": self.elapsed(), "stages": dict(self.stages), "spans": spans}
+
+    def save(self, path: str):
+        with open(path, "w", encoding="UTF-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+
+_current: ContextVar[Optional[Timings]] = ContextVar("timings", default=None)
+
+
+def record(name: str, seconds: float, items: int = 1):
+    metrics.observe_span(name, seconds, items)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds, items)
+
+
+@contextmanager
+def span(name: str, items: int = 1):
+    # times the block, `items` is the number of frames, faces, windows, ... it processed
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, items)
+
+
+def timed_iter(name: str, iterable: Iterable[T]) -> Iterator[T]:
+    # times the wait for each item of `iterable`, e.g. for the next decoded frame
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(name, time.perf_counter() - start)
+        yield item
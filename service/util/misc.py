@@ -1,14 +1,21 @@
 import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from itertools import islice
 from pathlib import Path
-from typing import BinaryIO, List
+from typing import BinaryIO, List, Iterable, Iterator, TypeVar, Optional, Tuple
 
 from fastapi import HTTPException, Request, status
-from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
+from starlette.types import Receive, Scope, Send
 from tqdm.auto import tqdm
 from urllib.request import urlretrieve
 
 from util.consts import AUDIO_MODEL_PATH, LINGUISTIC_MODEL_EN_PATH, LINGUISTIC_MODEL_ZH_PATH, AUDIO_MODEL_URL, \
-    LINGUISTIC_MODEL_EN_URL, LINGUISTIC_MODEL_ZH_URL
+    LINGUISTIC_MODEL_EN_URL, LINGUISTIC_MODEL_ZH_URL, RANGE_CHUNK_SIZE, DATA_DIR
+
+T = TypeVar("T")
 
 
 class VideoNamePool:
@@ -17,9 +24,9 @@ class VideoNamePool:
     @classmethod
     def init(cls):
         all_video_ids: List[int] = []
-        if not os.path.exists("data"):
-            os.mkdir("data")
-        for directory in filter(lambda x: os.path.isdir(os.path.join("data", x)), os.listdir("data")):
+        if not os.path.exists(DATA_DIR):
+            os.makedirs(DATA_DIR)
+        for directory in filter(lambda x: os.path.isdir(os.path.join(DATA_DIR, x)), os.listdir(DATA_DIR)):
             try:
                 all_video_ids.append(int(directory))
             except ValueError:
@@ -50,75 +57,204 @@ def prepare_checkpoints():
         download_file(LINGUISTIC_MODEL_ZH_URL, LINGUISTIC_MODEL_ZH_PATH)
 
 
-# https://github.com/tiangolo/fastapi/issues/1240
-def send_bytes_range_requests(
-    file_obj: BinaryIO, start: int, end: int, chunk_size: int = 10_000
-):
-    """Send a file in chunks using Range Requests specification RFC7233
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def get_rss() -> Optional[int]:
+    # resident memory of the process in bytes, None where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _read_at(file_obj: BinaryIO, offset: int, size: int) -> bytes:
+    file_obj.seek(offset)
+    return file_obj.read(size)
+
+
+def _invalid_range(range_header: str, file_size: int) -> HTTPException:
+    return HTTPException(
+        status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+        detail=f"Invalid request range (Range:{range_header!r})",
+        headers={"content-range": f"bytes */{file_size}"},
+    )
+
+
+def _get_ranges(range_header: str, file_size: int) -> List[Tuple[int, int]]:
+    """Parses a `bytes=` Range header with one or more ranges, the ranges returned are inclusive"""
+    if not range_header.startswith("bytes="):
+        raise _invalid_range(range_header, file_size)
+
+    ranges = []
+    for part in range_header[len("bytes="):].split(","):
+        start_text, sep, end_text = part.strip().partition("-")
+        try:
+            if sep == "":
+                raise ValueError
+            if start_text == "":
+                # suffix range, the last bytes of the file
+                start = max(file_size - int(end_text), 0)
+                end = file_size - 1
+            else:
+                start = int(start_text)
+                end = min(int(end_text), file_size - 1) if end_text != "" else file_size - 1
+        except ValueError:
+            raise _invalid_range(range_header, file_size)
+        if 0 <= start <= end:
+            ranges.append((start, end))
+
+    if len(ranges) == 0:
+        raise _invalid_range(range_header, file_size)
+
+    # overlapping and adjacent ranges are sent once
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
 
-    `start` and `end` parameters are inclusive due to specification
+def _etag_matches(header: str, etag: str) -> bool:
+    # weak comparison, as used by If-None-Match
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or any(tag.replace("W/", "", 1) == etag for tag in tags)
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _if_range_matches(request: Request, etag: str, last_modified: str) -> bool:
+    # a Range is only honoured when the client still has the same version of the file, compared strongly, so a weak
+    # validator never matches (RFC 7233 section 3.2)
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if if_range.startswith("W/"):
+        return False
+    if if_range.startswith('"'):
+        return if_range == etag
+    return if_range == last_modified
+
+
+class FileRangeResponse(Response):
+    """File response with Range Requests (RFC7233), including multiple ranges, and conditional requests (RFC7232)
+
+    The body is sent with large reads in the threadpool.
     """
-    with file_obj as f:
-        f.seek(start)
-        pos = f.tell()
-        while pos <= end:
-            read_size = min(chunk_size, end + 1 - pos)
-            yield f.read(read_size)
 
+    def __init__(self, request: Request, file_path: str, content_type: str, chunk_size: int = RANGE_CHUNK_SIZE):
+        stat = os.stat(file_path)
+        self.file_path = file_path
+        self.file_size = stat.st_size
+        self.chunk_size = chunk_size
+        self.content_type = content_type
+        self.boundary = None
+        self.ranges: List[Tuple[int, int]] = []
 
-def _get_range_header(range_header: str, file_size: int) -> tuple[int, int]:
-    def _invalid_range():
-        return HTTPException(
-            status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
-            detail=f"Invalid request range (Range:{range_header!r})",
-        )
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": last_modified,
+            # the results of a video can be written again, so the client revalidates with the etag
+            "cache-control": "no-cache",
+            "access-control-expose-headers": (
+                "content-type, accept-ranges, content-length, "
+                "content-range, content-encoding, etag, last-modified"
+            ),
+        }
 
-    try:
-        h = range_header.replace("bytes=", "").split("-")
-        start = int(h[0]) if h[0] != "" else 0
-        end = int(h[1]) if h[1] != "" else file_size - 1
-    except ValueError:
-        raise _invalid_range()
+        if _not_modified(request, etag, stat.st_mtime):
+            super().__init__(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+            return
 
-    if start > end or start < 0 or end > file_size - 1:
-        raise _invalid_range()
-    return start, end
+        range_header = request.headers.get("range")
+        if range_header is None or not _if_range_matches(request, etag, last_modified):
+            self.ranges = [(0, self.file_size - 1)] if self.file_size > 0 else []
+            headers["content-type"] = content_type
+            headers["content-length"] = str(self.file_size)
+            super().__init__(status_code=status.HTTP_200_OK, headers=headers)
+            return
+
+        self.ranges = _get_ranges(range_header, self.file_size)
+        if len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            headers["content-type"] = content_type
+            headers["content-length"] = str(end - start + 1)
+            headers["content-range"] = f"bytes {start}-{end}/{self.file_size}"
+        else:
+            self.boundary = uuid.uuid4().hex
+            headers["content-type"] = f"multipart/byteranges; boundary={self.boundary}"
+            headers["content-length"] = str(
+                sum(len(self._part_header(k)) + end - start + 1 for k, (start, end) in enumerate(self.ranges))
+                + len(self._closing_boundary())
+            )
+        super().__init__(status_code=status.HTTP_206_PARTIAL_CONTENT, headers=headers)
+
+    def _part_header(self, k: int) -> bytes:
+        start, end = self.ranges[k]
+        return (
+            ("\r\n" if k > 0 else "")
+            + f"--{self.boundary}\r\n"
+            + f"content-type: {self.content_type}\r\n"
+            + f"content-range: bytes {start}-{end}/{self.file_size}\r\n\r\n"
+        ).encode("latin-1")
+
+    def _closing_boundary(self) -> bytes:
+        return f"\r\n--{self.boundary}--\r\n".encode("latin-1")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD" or len(self.ranges) == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.file_path, mode="rb") as f:
+            for k, (start, end) in enumerate(self.ranges):
+                if self.boundary is not None:
+                    await send({"type": "http.response.body", "body": self._part_header(k), "more_body": True})
+                pos = start
+                while pos <= end:
+                    chunk = await run_in_threadpool(_read_at, f, pos, min(self.chunk_size, end + 1 - pos))
+                    pos += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            closing = self._closing_boundary() if self.boundary is not None else b""
+            await send({"type": "http.response.body", "body": closing, "more_body": False})
+
+        if self.background is not None:
+            await self.background()
 
 
 def range_requests_response(
     request: Request, file_path: str, content_type: str
 ):
-    """Returns StreamingResponse using Range Requests of a given file"""
-
-    file_size = os.stat(file_path).st_size
-    range_header = request.headers.get("range")
-
-    headers = {
-        "content-type": content_type,
-        "accept-ranges": "bytes",
-        "content-encoding": "identity",
-        "content-length": str(file_size),
-        "access-control-expose-headers": (
-            "content-type, accept-ranges, content-length, "
-            "content-range, content-encoding"
-        ),
-    }
-    start = 0
-    end = file_size - 1
-    status_code = status.HTTP_200_OK
-
-    if range_header is not None:
-        start, end = _get_range_header(range_header, file_size)
-        size = end - start + 1
-        headers["content-length"] = str(size)
-        headers["content-range"] = f"bytes {start}-{end}/{file_size}"
-        status_code = status.HTTP_206_PARTIAL_CONTENT
-
-    return StreamingResponse(
-        send_bytes_range_requests(open(file_path, mode="rb"), start, end),
-        headers=headers,
-        status_code=status_code,
-    )
+    """Returns FileRangeResponse of a given file"""
+    if not os.path.isfile(file_path):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="File not found")
+    return FileRangeResponse(request, file_path=file_path, content_type=content_type)
 
 
 class DownloadProgressBar(tqdm):
@@ -0,0 +1,49 @@
+import os
+from contextlib import nullcontext
+from typing import Optional
+
+import torch
+from torch import nn
+
+from util.consts import DEVICE, PROFILES, DEFAULT_PROFILE, MODEL_VERSIONS
+
+_profile: Optional[dict] = None
+
+
+def set_profile(name: str) -> dict:
+    # the models are loaded with the profile active when they are first used, so it is set before serving
+    global _profile
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile {name}, choose from {', '.join(PROFILES)}")
+    profile = {"name": name, **PROFILES[name]}
+    if profile["precision"] == "int8" and DEVICE.type != "cpu":
+        # the dynamically quantized layers only run on CPU, the GPU gets the other reduced precision when it has it
+        profile["precision"] = "bf16" if DEVICE.type == "cuda" and torch.cuda.is_bf16_supported() else "fp32"
+    _profile = profile
+    return profile
+
+
+def get_profile() -> dict:
+    if _profile is None:
+        return set_profile(os.environ.get("EMOLYSIS_PROFILE", DEFAULT_PROFILE))
+    return _profile
+
+
+def model_versions() -> dict:
+    # the models the heads run with the active profile
+    return {head: version.format(**get_profile()) for head, version in MODEL_VERSIONS.items()}
+
+
+def quantize(model: nn.Module) -> nn.Module:
+    # int8 weights for the linear layers, the activations are quantized on the fly
+    if get_profile()["precision"] == "int8":
+        model.eval()
+        torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def autocast():
+    # context of the forward passes of the heads, their outputs are converted back with `.float()`
+    if get_profile()["precision"] == "bf16":
+        return torch.autocast(DEVICE.type, dtype=torch.bfloat16)
+    return nullcontext()
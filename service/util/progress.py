@@ -0,0 +1,117 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+from starlette.websockets import WebSocket
+
+
+Sender = Callable[[dict], Awaitable[None]]
+
+
+# protocol 1: the client acknowledges every message before the next one is sent.
+# protocol 2: messages are pushed without acks, a slow client only gets the latest progress tick of each status.
+ACK_PROTOCOL = 1
+PUSH_PROTOCOL = 2
+
+
+def socket_sender(socket: WebSocket, protocol: int = ACK_PROTOCOL) -> Sender:
+    if protocol >= PUSH_PROTOCOL:
+        return socket.send_json
+
+    async def send(message: dict):
+        await socket.send_json(message)
+        await socket.receive_text()
+
+    return send
+
+
+class CoalescingQueue:
+    # Messages waiting for one subscriber. A message replaces the pending one with the same status, so stale progress
+    # ticks are dropped and the queue never holds more than one message per status, however slow the subscriber is.
+
+    def __init__(self):
+        self.pending: "OrderedDict[str, dict]" = OrderedDict()
+        self.event = asyncio.Event()
+        self.closed = False
+
+    def put(self, message: dict):
+        self.pending[message["status"]] = message
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    async def get(self) -> Optional[dict]:
+        # None once the queue is closed and drained
+        while len(self.pending) == 0:
+            if self.closed:
+                return None
+            self.event.clear()
+            await self.event.wait()
+        return self.pending.popitem(last=False)[1]
+
+
+class ProgressChannel:
+    # handle given to a head running in a worker thread, `send` never blocks on the socket
+
+    def __init__(self, progress: "OrderedProgress", stage: str):
+        self.progress = progress
+        self.stage = stage
+
+    def send(self, status: str, data: Optional[dict] = None):
+        self.progress.publish(self.stage, status, data)
+
+    def done(self, data: Optional[dict] = None):
+        self.progress.publish(self.stage, f"{self.stage} done", data, final=True)
+
+
+class OrderedProgress:
+    # Collects the status messages of heads running concurrently and forwards them to the socket in the fixed
+    # order of `stages`. Messages of a later stage are buffered until every earlier stage is done, while
+    # buffered, only the latest progress tick of a stage is kept.
+
+    def __init__(self, stages: Sequence[str], loop: asyncio.AbstractEventLoop):
+        self.stages = list(stages)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def channel(self, stage: str) -> ProgressChannel:
+        return ProgressChannel(self, stage)
+
+    def publish(self, stage: str, status: str, data: Optional[dict] = None, final: bool = False):
+        message = {"status": status, "data": data if data is not None else {}}
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (stage, message, final))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    async def forward(self, send: Sender):
+        current = 0
+        buffers: Dict[str, List[dict]] = {stage: [] for stage in self.stages}
+        finished = set()
+
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                break
+            stage, message, final = item
+
+            if current < len(self.stages) and stage == self.stages[current]:
+                await send(message)
+            else:
+                buffer = buffers[stage]
+                if not final and len(buffer) > 0 and buffer[-1]["status"] == message["status"]:
+                    buffer[-1] = message
+                else:
+                    buffer.append(message)
+
+            if final:
+                finished.add(stage)
+            # release the buffered messages of the stages that are next in line
+            while current < len(self.stages) and self.stages[current] in finished:
+                current += 1
+                if current < len(self.stages):
+                    for buffered in buffers[self.stages[current]]:
+                        await send(buffered)
+                    buffers[self.stages[current]] = []
@@ -0,0 +1,167 @@
+import queue
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from math import ceil
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from util.consts import VIDEO_DECODE_MAX_SIDE, FRAME_PREFETCH, VIDEO_HWACCEL
+
+# end of the ffmpeg log shown when the decoding fails
+_STDERR_TAIL = 4096
+
+
+def _even(value: float) -> int:
+    # most ffmpeg pixel format conversions want even dimensions
+    return max(2, int(round(value / 2)) * 2)
+
+
+class FrameReader:
+    # Decodes the frames of a video with ffmpeg in a background thread, at most `prefetch` frames ahead of the
+    # consumer, so decoding overlaps with the inference. ffmpeg only outputs every `stride`-th frame, already scaled
+    # to fit in `max_side`, and the frames are read into a fixed pool of buffers: a frame yielded by `__iter__` stays
+    # valid until `hold` more frames have been yielded. `scale_x`/`scale_y` map the decoded coordinates back to the
+    # original resolution.
+
+    def __init__(self, file_path: str, stride: int = 1, max_side: Optional[int] = VIDEO_DECODE_MAX_SIDE,
+        prefetch: int = FRAME_PREFETCH, hold: int = 1, hwaccel: Optional[str] = VIDEO_HWACCEL
+    ):
+        infos = ffmpeg_parse_infos(file_path)
+        self.file_path = file_path
+        self.fps = infos["video_fps"]
+        self.duration = infos["duration"]
+        # same frame count as moviepy's `iter_frames`
+        self.total = ceil(self.fps * self.duration)
+        self.stride = stride
+        self.prefetch = prefetch
+        self.hold = hold
+        self.hwaccel = hwaccel
+
+        width, height = infos["video_size"]
+        # ffmpeg applies the rotation metadata while decoding
+        if infos.get("video_rotation", 0) in (90, 270):
+            width, height = height, width
+        self.width, self.height = width, height
+
+        scale = min(1.0, max_side / max(width, height)) if max_side is not None else 1.0
+        self.output_width = _even(width * scale) if scale < 1 else width
+        self.output_height = _even(height * scale) if scale < 1 else height
+        self.scale_x = width / self.output_width
+        self.scale_y = height / self.output_height
+
+        self._process: Optional[subprocess.Popen] = None
+        # ffmpeg logs into a file, a pipe nobody reads while the frames stream would block it once full
+        self._stderr = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def __len__(self) -> int:
+        return ceil(self.total / self.stride)
+
+    def _command(self):
+        filters = []
+        if self.stride > 1:
+            filters.append(f"select=not(mod(n\\,{self.stride}))")
+        if (self.output_width, self.output_height) != (self.width, self.height):
+            filters.append(f"scale={self.output_width}:{self.output_height}:flags=area")
+
+        cmd = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+        if self.hwaccel is not None:
+            cmd += ["-hwaccel", self.hwaccel]
+        cmd += ["-i", self.file_path, "-an"]
+        if len(filters) > 0:
+            cmd += ["-vf", ",".join(filters)]
+        # keep one output frame per selected input frame, the frame index is derived from the output order
+        cmd += ["-vsync", "0", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+        return cmd
+
+    def _read(self, free: queue.Queue, frames: queue.Queue):
+        try:
+            for k in range(len(self)):
+                buffer = free.get()
+                if buffer is None or self._stopped.is_set():
+                    return
+                view = memoryview(buffer).cast("B")
+                read = 0
+                while read < len(view):
+                    n = self._process.stdout.readinto(view[read:])
+                    if not n:
+                        break
+                    read += n
+                if read < len(view):
+                    # the container announced more frames than the stream has
+                    break
+                frames.put((k * self.stride, buffer))
+            # the stream can also have more frames than announced, they are dropped so ffmpeg can finish
+            while not self._stopped.is_set() and self._process.stdout.read(1 << 20):
+                pass
+        except Exception as e:
+            frames.put(e)
+        finally:
+            frames.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[int, np.ndarray]]:
+        shape = (self.output_height, self.output_width, 3)
+        free = queue.Queue()
+        for _ in range(self.prefetch + self.hold + 1):
+            free.put(np.empty(shape, dtype=np.uint8))
+        frames = queue.Queue(maxsize=self.prefetch)
+
+        self._stopped.clear()
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(self._command(), stdout=subprocess.PIPE, stderr=self._stderr,
+            stdin=subprocess.DEVNULL, bufsize=10 ** 8)
+        self._thread = threading.Thread(target=self._read, args=(free, frames), daemon=True, name="frame-reader")
+        self._thread.start()
+
+        held = deque()
+        eof = False
+        try:
+            while True:
+                item = frames.get()
+                if item is None:
+                    eof = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                i, buffer = item
+                held.append(buffer)
+                if len(held) > self.hold:
+                    free.put(held.popleft())
+                yield i, buffer
+        finally:
+            self._close(free, frames, eof)
+
+    def _stderr_tail(self) -> str:
+        self._stderr.seek(max(0, self._stderr.seek(0, 2) - _STDERR_TAIL))
+        return self._stderr.read().decode(errors="ignore")
+
+    def _close(self, free: Optional[queue.Queue] = None, frames: Optional[queue.Queue] = None, eof: bool = False):
+        # `eof`: every frame was read, ffmpeg is left to exit on its own and its return code is checked
+        if self._process is None:
+            return
+        if not eof and self._process.poll() is None:
+            # stopped before the end of the video
+            self._stopped.set()
+            self._process.kill()
+        # unblock the reader thread waiting for a buffer or for room in the queue
+        if free is not None:
+            free.put(None)
+        if frames is not None:
+            while self._thread.is_alive():
+                try:
+                    frames.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        self._thread.join()
+
+        try:
+            return_code = self._process.wait()
+            if eof and return_code != 0:
+                raise RuntimeError(f"Failed to decode video: {self._stderr_tail()}")
+        finally:
+            self._stderr.close()
@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from util.consts import INFERENCE_WORKERS
+
+_inference_executor: Optional[ThreadPoolExecutor] = None
+_inference_workers = INFERENCE_WORKERS
+
+
+def init_inference_executor(max_workers: int = INFERENCE_WORKERS) -> ThreadPoolExecutor:
+    global _inference_executor, _inference_workers
+    if _inference_executor is not None:
+        _inference_executor.shutdown(wait=False)
+    _inference_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+    _inference_workers = max_workers
+    return _inference_executor
+
+
+def get_inference_executor() -> ThreadPoolExecutor:
+    # shared by every job, so the blocking inference never runs on the event loop and concurrent uploads
+    # do not start more heads than there are workers
+    if _inference_executor is None:
+        return init_inference_executor()
+    return _inference_executor
+
+
+def get_inference_workers() -> int:
+    # heads that can run at the same time
+    return _inference_workers
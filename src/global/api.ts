@@ -1,4 +1,5 @@
 export const getRemoteUploadApi = () => `/api/upload`
+export const getRemoteStreamUploadApi = () => `/api/upload/stream`
 export const getRemoteDataPath = (videoId: string) => `/api/data/${videoId}`;
 export const getRemoteDataFps = (videoId: string) => `/api/fps/${videoId}`;
 export const getLocalDataPath = (videoId: string) => `/data/${videoId}`
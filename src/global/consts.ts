@@ -15,11 +15,15 @@ export type MessageStatus =
     | "visual"
     | "visual done"
     | "done"
+    | "failed"
 export type MessageProcessData = { current: number, total: number }
 export type MessageResultData = { id: string, audio: string, visual: string, text: string }
 export type MessageVideoData = { fps: number }
+export type MessageFailedData = { error: string | null }
 
-export interface Message<T extends (MessageProcessData | MessageVideoData | MessageResultData | {})> {
+export type MessageData = MessageProcessData | MessageVideoData | MessageResultData | MessageFailedData | {}
+
+export interface Message<T extends MessageData> {
     status: MessageStatus,
     data: T
 }
\ No newline at end of file
@@ -1,3 +1,5 @@
+import * as d3 from "d3";
+
 export interface DataRow {
     frame: number
     valence: number
@@ -6,3 +8,72 @@ export interface DataRow {
 }
 
 export type Data = Map<number, DataRow>
+
+
+export type Cell = string | number
+export type Table = Array<Record<string, Cell>>
+
+// packed columnar results served by /api/data instead of the CSV when the client accepts them
+const COLUMNAR_MEDIA_TYPE = "application/vnd.emolysis.columnar"
+
+function float16ToNumber(bits: number): number {
+    const sign = bits & 0x8000 ? -1 : 1
+    const exponent = (bits >> 10) & 0x1f
+    const fraction = bits & 0x3ff
+    if (exponent === 0) {
+        return sign * 2 ** -14 * (fraction / 1024)
+    } else if (exponent === 0x1f) {
+        return fraction ? NaN : sign * Infinity
+    }
+    return sign * 2 ** (exponent - 15) * (1 + fraction / 1024)
+}
+
+function readColumn(buffer: ArrayBuffer, dtype: string, offset: number, rows: number): ArrayLike<number> {
+    switch (dtype) {
+        case "float32":
+            return new Float32Array(buffer, offset, rows)
+        case "int32":
+            return new Int32Array(buffer, offset, rows)
+        case "int16":
+            return new Int16Array(buffer, offset, rows)
+        case "float16":
+            return Array.from(new Uint16Array(buffer, offset, rows), float16ToNumber)
+        default:
+            throw new Error(`Unknown column type ${dtype}`)
+    }
+}
+
+function parseColumnar(buffer: ArrayBuffer): Table {
+    const view = new DataView(buffer)
+    const headerLength = view.getUint32(4, true)
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength))) as {
+        rows: number,
+        columns: Array<{ name: string, dtype: string, offset: number }>
+    }
+    const columns = header.columns.map(column => ({
+        name: column.name,
+        values: readColumn(buffer, column.dtype, column.offset, header.rows)
+    }))
+
+    const table: Table = []
+    for (let i = 0; i < header.rows; i++) {
+        const row: Record<string, Cell> = {}
+        columns.forEach(column => row[column.name] = column.values[i])
+        table.push(row)
+    }
+    return table
+}
+
+export async function loadTable(path: string): Promise<Table> {
+    const response = await fetch(path, {headers: {"Accept": `${COLUMNAR_MEDIA_TYPE}, text/csv;q=0.9, */*;q=0.8`}})
+    if (!response.ok) {
+        throw new Error(`${response.status} ${response.statusText}`)
+    }
+    if (response.headers.get("content-type")?.startsWith(COLUMNAR_MEDIA_TYPE)) {
+        return parseColumnar(await response.arrayBuffer())
+    }
+    return d3.csvParse(await response.text())
+}
+
+export const toInt = (cell: Cell): number => typeof cell === "number" ? Math.trunc(cell) : parseInt(cell)
+export const toFloat = (cell: Cell): number => typeof cell === "number" ? cell : parseFloat(cell)
@@ -1,31 +1,33 @@
 import { useDataPathStore } from "@/stores/dataPathStore";
-import * as d3 from "d3";
-import type { DataRow } from "@/preprocess/common";
+import type { Cell, DataRow } from "@/preprocess/common";
+import { loadTable, toFloat, toInt } from "@/preprocess/common";
 
 type FaceCsv = Array<{
-    frame: string,
-    x1: string,
-    x2: string,
-    y1: string,
-    y2: string,
-    box_prob: string,
-    emotion: string,
-    emotion0: string,
-    emotion1: string,
-    emotion2: string,
-    emotion3: string,
-    emotion4: string,
-    emotion5: string,
-    emotion6: string,
-    emotion7: string,
-    emotion8: string,
-    valence: string,
-    arousal: string,
+    frame: Cell,
+    face_id?: Cell,
+    x1: Cell,
+    x2: Cell,
+    y1: Cell,
+    y2: Cell,
+    box_prob: Cell,
+    emotion: Cell,
+    emotion0: Cell,
+    emotion1: Cell,
+    emotion2: Cell,
+    emotion3: Cell,
+    emotion4: Cell,
+    emotion5: Cell,
+    emotion6: Cell,
+    emotion7: Cell,
+    emotion8: Cell,
+    valence: Cell,
+    arousal: Cell,
 }>
 
 type FaceData = Map<number, Array<FaceRow>>
 
 export interface FaceRow extends DataRow {
+    faceId?: number
     x1: number
     x2: number
     y1: number
@@ -39,20 +41,21 @@ const faceData: FaceData = new Map();
 
 async function loadFaceData(): Promise<void> {
     const dataPathStore = useDataPathStore()
-    const d = await d3.csv(dataPathStore.faceDataPath) as FaceCsv
+    const d = await loadTable(dataPathStore.faceDataPath) as FaceCsv
     d.forEach(row => {
-        const currentFrame = parseInt(row.frame)
+        const currentFrame = toInt(row.frame)
         const faceRow = {
             frame: currentFrame,
-            x1: parseInt(row.x1),
-            x2: parseInt(row.x2),
-            y1: parseInt(row.y1),
-            y2: parseInt(row.y2),
-            boxProb: parseFloat(row.box_prob),
-            valence: parseInt(row.valence),
-            arousal: parseInt(row.arousal),
-            emotion: parseInt(row.emotion),
-            emotionProb: [row.emotion0, row.emotion1, row.emotion2, row.emotion3, row.emotion4, row.emotion5, row.emotion6, row.emotion7, row.emotion8].map(parseFloat)
+            faceId: row.face_id !== undefined ? toInt(row.face_id) : undefined,
+            x1: toInt(row.x1),
+            x2: toInt(row.x2),
+            y1: toInt(row.y1),
+            y2: toInt(row.y2),
+            boxProb: toFloat(row.box_prob),
+            valence: toInt(row.valence),
+            arousal: toInt(row.arousal),
+            emotion: toInt(row.emotion),
+            emotionProb: [row.emotion0, row.emotion1, row.emotion2, row.emotion3, row.emotion4, row.emotion5, row.emotion6, row.emotion7, row.emotion8].map(toFloat)
         }
         if (faceData.has(currentFrame)) {
             faceData.get(currentFrame)!.push(faceRow)
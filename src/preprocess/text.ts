@@ -1,23 +1,23 @@
 import { useDataPathStore } from "@/stores/dataPathStore";
-import * as d3 from "d3";
 import { config } from "@/config";
 import _ from "lodash";
-import type { DataRow } from "@/preprocess/common";
+import type { Cell, DataRow } from "@/preprocess/common";
+import { loadTable, toFloat, toInt } from "@/preprocess/common";
 
 type TextCsv = Array<{
-    start: string,
-    end: string,
-    valence: string,
-    arousal: string,
-    emotion0: string,
-    emotion1: string,
-    emotion2: string,
-    emotion3: string,
-    emotion4: string,
-    emotion5: string,
-    emotion6: string,
-    emotion7: string,
-    emotion8: string
+    start: Cell,
+    end: Cell,
+    valence: Cell,
+    arousal: Cell,
+    emotion0: Cell,
+    emotion1: Cell,
+    emotion2: Cell,
+    emotion3: Cell,
+    emotion4: Cell,
+    emotion5: Cell,
+    emotion6: Cell,
+    emotion7: Cell,
+    emotion8: Cell
 }>
 
 type TextData = Map<number, TextRow>
@@ -28,7 +28,7 @@ const textData: TextData = new Map();
 
 async function loadTextData(): Promise<void> {
     const dataPathStore = useDataPathStore()
-    const d = await d3.csv(dataPathStore.textDataPath) as TextCsv
+    const d = await loadTable(dataPathStore.textDataPath) as TextCsv
 
     d.forEach((row, index) => {
         // drop last row
@@ -36,11 +36,11 @@ async function loadTextData(): Promise<void> {
             return
         }
 
-        const start = parseInt(row.start) * config.fps
-        const end = parseInt(row.end) * config.fps
-        const valence = _.round(parseFloat(row.valence))
-        const arousal = _.round(parseFloat(row.arousal))
-        const emotionProb = [row.emotion0, row.emotion1, row.emotion2, row.emotion3, row.emotion4, row.emotion5, row.emotion6, row.emotion7, row.emotion8].map(parseFloat)
+        const start = toInt(row.start) * config.fps
+        const end = toInt(row.end) * config.fps
+        const valence = _.round(toFloat(row.valence))
+        const arousal = _.round(toFloat(row.arousal))
+        const emotionProb = [row.emotion0, row.emotion1, row.emotion2, row.emotion3, row.emotion4, row.emotion5, row.emotion6, row.emotion7, row.emotion8].map(toFloat)
 
         _.range(start, end).forEach(frame => {
             textData.set(frame, {